@@ -0,0 +1,351 @@
+"""
+Сквозной замер производительности main.py на синтетических выгрузках 1С.
+Для каждого режима (appius, mto, delivery_order, notification) и размера формируется лист TDSheet с колонками
+из attributes_*.xlsx и колонками, которые использует _read_excel. main.py запускается дважды против локальной
+заглушки API (neosintez_stub.py): первичная загрузка и повторная загрузка файла с изменениями
+(новые, измененные и отмененные строки).
+Для каждого запуска фиксируются время, число запросов к API по типам, пиковая память процесса и длительность этапов
+из сводки метрик запуска.
+
+С флагом --rows-memory main.py не запускается: сравнивается память под строки данных LevelOne в виде словарей
+(прежний формат) и в виде кортежей по схеме колонок (RowSchema в main.py).
+
+Запуск:
+    python benchmark.py --modes mto,notification --sizes 1000,10000 --new 0.05 --changed 0.1 --cancelled 0.05
+    python benchmark.py --sizes 100000 --rows-memory
+    python benchmark.py --modes notification --sizes 10000 --extra-columns 50
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import date, timedelta
+from glob import glob
+
+import pandas as pd
+import requests
+
+import neosintez_stub
+
+APP_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# префиксы имен файлов выгрузки по режимам, как в LevelOne.get_file_path
+FILE_PREFIX = {
+    'appius': 'РД',
+    'mto': 'ЗО',
+    'delivery_order': 'Д',
+    'notification': 'У',
+}
+# колонки, которые _read_excel читает как строки, и колонки, которые использует обработка режима
+MODE_COLUMNS = {
+    'appius': ['№ поз. по ГП', 'Изм.', 'Обозначение'],
+    'mto': ['Код (НСИ)', 'Потребность.Номер', 'Потребность.Этап согласования', 'Номенклатурная позиция',
+            'Номер спецификации (РД)', 'Номер и дата служебной записки'],
+    'delivery_order': ['Документ заказа.Номер', 'Потребность.Номенклатура.Код', 'Потребность.Номер',
+                       'Потребность.Номенклатура.Наименование'],
+    'notification': ['Потребность.Номенклатура.Код', 'Потребность.Номер', 'Плановая дата прихода на склад',
+                     'Дата отгрузки', 'Потребность.Номенклатура.Наименование'],
+}
+# колонки, из которых строится ключ строки
+KEY_COLUMNS = {
+    'appius': {'Обозначение'},
+    'mto': {'Потребность.Номер'},
+    'delivery_order': {'Документ заказа.Номер', 'Потребность.Номер'},
+    'notification': {'Потребность.Номер', 'Дата отгрузки', 'Плановая дата прихода на склад'},
+}
+# колонки, которые _read_excel вычисляет сам
+DERIVED_COLUMNS = {
+    'appius': set(),
+    'mto': set(),
+    'delivery_order': {'Заказ-Потребность'},
+    'notification': {'Потребность-Дата отгрузки-Дата прихода', 'Папка'},
+}
+# имя LevelOne для синтетических файлов
+LEVEL_ONE_NAME = 'BENCH001'
+# число различных значений ссылочных атрибутов и папок второго уровня
+REFERENCE_VALUES = 20
+LEVEL_TWO_VALUES = 10
+
+
+def read_mapping(config):
+    mapping = pd.read_excel(os.path.join(APP_DIRECTORY, config['attributes_file']), sheet_name='Лист1')
+    return json.loads(mapping.to_json(orient='records', force_ascii=False))
+
+
+def get_columns(mode, config, mapping):
+    """
+    Функция get_columns возвращает колонки синтетического файла и их типы.
+
+    :return: Словарь {колонка: тип атрибута}, для колонок вне мэпинга тип 2
+    """
+    columns = {}
+    for attribute in mapping:
+        columns.setdefault(attribute['name'], attribute['type'])
+    for column in MODE_COLUMNS[mode] + [config['level_two_column_name']]:
+        columns.setdefault(column, 2)
+    for column in DERIVED_COLUMNS[mode]:
+        columns.pop(column, None)
+    return columns
+
+
+def random_date(rnd):
+    return (date(2021, 1, 1) + timedelta(days=rnd.randrange(1500))).strftime('%d.%m.%Y')
+
+
+def generate_value(column, atr_type, row_number, rnd, version=0):
+    if atr_type == 1:
+        return round(rnd.uniform(1, 1000), 3) + version
+    elif atr_type in (3, 5):
+        return random_date(rnd)
+    elif atr_type == 8:
+        return f'{column} {rnd.randrange(REFERENCE_VALUES)}'
+    elif atr_type == 6:
+        return f'https://example.local/{row_number}'
+    return f'{column} {row_number} v{version}'
+
+
+def generate_rows(mode, config, columns, numbers, rnd):
+    """
+    Функция generate_rows формирует строки выгрузки с ключами, построенными из номеров строк numbers.
+
+    :return: Список словарей
+    """
+    level_two_column_name = config['level_two_column_name']
+    rows = []
+    for number in numbers:
+        row = {column: generate_value(column, atr_type, number, rnd) for column, atr_type in columns.items()}
+        row[level_two_column_name] = f'Папка {number % LEVEL_TWO_VALUES}'
+        if mode == 'appius':
+            row['Обозначение'] = f'BENCH-{number:07d}'
+            row['Изм.'] = str(rnd.randrange(3))
+        elif mode == 'mto':
+            row['Потребность.Номер'] = f'{number:09d}'
+            row['Номенклатурная позиция'] = f'Номенклатура {number}'
+            row['Номер спецификации (РД)'] = f'РД {number}'
+        elif mode == 'delivery_order':
+            row['Документ заказа.Номер'] = f'ДЗ{number // 10:07d}'
+            row['Потребность.Номер'] = f'{number:09d}'
+            row['Потребность.Номенклатура.Наименование'] = f'Номенклатура {number}'
+        elif mode == 'notification':
+            row['Потребность.Номер'] = f'{number:09d}'
+            row['Потребность.Номенклатура.Наименование'] = f'Номенклатура {number}'
+        rows.append(row)
+    return rows
+
+
+def apply_churn(mode, config, columns, rows, rnd, new, changed, cancelled):
+    """
+    Функция apply_churn формирует следующую выгрузку: удаляет долю cancelled строк, меняет значение
+    одного атрибута у доли changed строк и добавляет долю new новых строк.
+
+    :return: Список словарей
+    """
+    size = len(rows)
+    rows = [dict(row) for row in rows]
+    rnd.shuffle(rows)
+    rows = rows[int(size * cancelled):]
+    changeable = [column for column, atr_type in columns.items()
+                  if atr_type in (1, 2, 8) and column not in KEY_COLUMNS[mode] and column != config['level_two_column_name']]
+    for row in rows[:int(size * changed)]:
+        column = rnd.choice(changeable)
+        row[column] = generate_value(column, columns[column], size, rnd, version=1)
+    rows += generate_rows(mode, config, columns, range(size, size + int(size * new)), rnd)
+    return rows
+
+
+def seed_stub(stub, config, mapping):
+    """Функция seed_stub создает в заглушке корень с ключом LEVEL_ONE_NAME и объекты справочников ссылочных атрибутов"""
+    stub.reset()
+    storage = stub.storage
+    storage.add('Benchmark root', config['root_class_id'], None, 'benchmark-root', {
+        config['config_attribute_id']: {'Value': LEVEL_ONE_NAME, 'Type': 2},
+        config['object_attribute_id']: {'Value': {'Id': 'benchmark-object', 'Name': 'Benchmark object'}, 'Type': 8},
+    })
+    for attribute in mapping:
+        if attribute['type'] != 8:
+            continue
+        if attribute['folder'] not in storage.objects:
+            storage.add(attribute['folder'], 'benchmark-folder', None, attribute['folder'])
+        for i in range(REFERENCE_VALUES):
+            storage.add(f'{attribute["name"]} {i}'.replace('.', ''), attribute['class'], attribute['folder'])
+
+
+def run_main(mode, workdir, options):
+    """
+    Функция run_main запускает main.py и возвращает время выполнения и код возврата.
+    """
+    started = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, os.path.join(APP_DIRECTORY, 'main.py'), mode, f'bench_{mode}', *options],
+        cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    return time.perf_counter() - started, process.returncode
+
+
+def read_summary(logs_path):
+    """
+    Функция read_summary читает последнюю сводку метрик запуска main.py.
+
+    :return: Пиковая память процесса в байтах и длительность этапов {этап: секунды}
+    """
+    summaries = sorted(glob(os.path.join(logs_path, '*_summary.json')), key=os.path.getmtime)
+    if not summaries:
+        return None, {}
+    with open(summaries[-1], encoding='utf-8') as f:
+        summary = json.loads(f.read())
+    phases = {}
+    for phase in summary['phases']:
+        phases[phase['phase']] = phases.get(phase['phase'], 0) + phase['seconds']
+    return summary.get('peak_rss'), phases
+
+
+def benchmark(mode, size, args, stub, server_url):
+    """
+    Функция benchmark выполняет первичную и повторную загрузку синтетической выгрузки размера size в режиме mode.
+
+    :return: Список результатов запусков
+    """
+    rnd = random.Random(args.seed)
+    workdir = os.path.join(args.workdir, f'{mode}_{size}')
+    shutil.rmtree(workdir, ignore_errors=True)
+    files_directory = os.path.join(workdir, 'files') + '/'
+    logs_path = os.path.join(workdir, 'logs') + '/'
+    os.makedirs(files_directory + 'prev')
+    os.makedirs(logs_path)
+
+    with open(os.path.join(APP_DIRECTORY, f'config_{mode}.json'), encoding='utf-8') as f:
+        config = json.loads(f.read())
+    mapping = read_mapping(config)
+    config.update({
+        'url': server_url,
+        'logs_path': logs_path,
+        'files_directory': files_directory,
+        'attributes_file': os.path.join(APP_DIRECTORY, config['attributes_file']),
+        'auth_data_file': os.path.join(workdir, 'auth_data.txt'),
+    })
+    with open(os.path.join(workdir, f'config_bench_{mode}.json'), 'w', encoding='utf-8') as f:
+        f.write(json.dumps(config, ensure_ascii=False, indent=2))
+    with open(config['auth_data_file'], 'w') as f:
+        f.write('grant_type=password&username=benchmark&password=benchmark')
+
+    seed_stub(stub, config, mapping)
+    columns = get_columns(mode, config, mapping)
+    rows = generate_rows(mode, config, columns, range(size), rnd)
+    results = []
+    for run in ('initial', 'churn'):
+        if run == 'churn':
+            rows = apply_churn(mode, config, columns, rows, rnd, args.new, args.changed, args.cancelled)
+        file_path = files_directory + f'{LEVEL_ONE_NAME}_{FILE_PREFIX[mode]}.xlsx'
+        frame = pd.DataFrame(rows)
+        # колонки, которых нет в мэпинге, как в широких выгрузках 1С
+        for number in range(args.extra_columns):
+            frame[f'Доп. колонка {number}'] = [f'Значение {number} {row_number}' for row_number in range(len(frame))]
+        frame.to_excel(file_path, sheet_name='TDSheet', index=False)
+
+        stats_before = requests.get(server_url + 'stub/stats').json()
+        seconds, returncode = run_main(mode, workdir, args.option)
+        peak_rss, phases = read_summary(logs_path)
+        stats_after = requests.get(server_url + 'stub/stats').json()
+        requests_count = {name: value - stats_before.get(name, 0) for name, value in stats_after.items()
+                          if name != 'objects' and value - stats_before.get(name, 0)}
+        result = {
+            'mode': mode,
+            'size': size,
+            'run': run,
+            'rows': len(rows),
+            'returncode': returncode,
+            'seconds': round(seconds, 3),
+            'requests': requests_count,
+            'requests_total': sum(requests_count.values()),
+            'peak_rss_mb': round(peak_rss / 1024 / 1024, 1) if peak_rss else None,
+            'objects': stats_after['objects'],
+            'phases': {name: round(value, 3) for name, value in phases.items()},
+        }
+        results.append(result)
+        print(f'{mode:15} {size:>7} {run:8} rows {len(rows):>7} rc {returncode} {seconds:9.2f} s '
+              f'requests {result["requests_total"]:>8} peak rss {result["peak_rss_mb"]} MB', flush=True)
+    return results
+
+
+def rows_memory(mode, size, seed):
+    """
+    Функция rows_memory замеряет память под size строк new_data в виде словарей {колонка: значение}
+    и в виде кортежей значений в порядке колонок схемы. Значения ячеек создаются заранее и общие для обоих форматов,
+    поэтому замеряются только контейнеры строк.
+
+    :return: Словарь результата
+    """
+    with open(os.path.join(APP_DIRECTORY, f'config_{mode}.json'), encoding='utf-8') as f:
+        config = json.loads(f.read())
+    mapping = read_mapping(config)
+    columns = get_columns(mode, config, mapping)
+    source = generate_rows(mode, config, columns, range(size), random.Random(seed))
+    names = [attribute['regexp_name'] if attribute['regexp'] else attribute['name'] for attribute in mapping]
+    schema_columns = tuple(dict.fromkeys(names + [config['level_two_column_name']]))
+    values = [[row.get(name) for name in schema_columns] for row in source]
+
+    result = {'mode': mode, 'size': size, 'columns': len(schema_columns)}
+    layouts = {
+        'dict': lambda row_values: dict(zip(schema_columns, row_values)),
+        'tuple': tuple,
+    }
+    for layout, make_row in layouts.items():
+        tracemalloc.start()
+        rows = [make_row(row_values) for row_values in values]
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result[f'{layout}_mb'] = round(current / 1024 / 1024, 1)
+        del rows
+    result['ratio'] = round(result['dict_mb'] / result['tuple_mb'], 1)
+    print(f'{mode:15} {size:>7} columns {result["columns"]:>3} dict {result["dict_mb"]:8.1f} MB '
+          f'tuple {result["tuple_mb"]:8.1f} MB x{result["ratio"]}', flush=True)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Замер производительности main.py на синтетических выгрузках')
+    parser.add_argument('--modes', default='appius,mto,delivery_order,notification')
+    parser.add_argument('--sizes', default='1000,10000,50000,200000')
+    parser.add_argument('--new', type=float, default=0.05, help='доля новых строк при повторной загрузке')
+    parser.add_argument('--changed', type=float, default=0.1, help='доля измененных строк при повторной загрузке')
+    parser.add_argument('--cancelled', type=float, default=0.05, help='доля отмененных строк при повторной загрузке')
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка ответа заглушки, секунды')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', default=os.path.join(APP_DIRECTORY, 'benchmark_data'))
+    parser.add_argument('--output', default='', help='json файл для результатов')
+    parser.add_argument('--option', action='append', default=[], help='флаг запуска main.py, например --option=--profile')
+    parser.add_argument('--extra-columns', type=int, default=0, help='число колонок выгрузки вне мэпинга')
+    parser.add_argument('--rows-memory', action='store_true', help='замер памяти под строки данных вместо запуска main.py')
+    args = parser.parse_args()
+
+    if args.rows_memory:
+        results = [rows_memory(mode, size, args.seed)
+                   for mode in args.modes.split(',') for size in map(int, args.sizes.split(','))]
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                f.write(json.dumps(results, ensure_ascii=False, indent=1))
+        return
+
+    stub = neosintez_stub.Stub(latency=args.latency)
+    server = neosintez_stub.serve(port=0, stub=stub)
+    server_url = f'http://127.0.0.1:{server.server_port}/'
+    results = []
+    try:
+        for mode in args.modes.split(','):
+            for size in map(int, args.sizes.split(',')):
+                results += benchmark(mode, size, args, stub, server_url)
+    finally:
+        server.shutdown()
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(results, ensure_ascii=False, indent=1))
+
+
+if __name__ == '__main__':
+    main()
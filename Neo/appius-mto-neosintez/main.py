@@ -1,19 +1,856 @@
 import sys
+import codecs
 import json
+import math
 import os
 import re
 import shutil
 import logging
-from datetime import datetime
+import multiprocessing
+import time
+import cProfile
+import tracemalloc
+import gzip
+import hashlib
+import io
+import random
+import threading
+from email.utils import parsedate_to_datetime
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from typing import List
 import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
 import pandas as pd
 
 
+class Metrics:
+    """
+    Класс Metrics собирает метрики запуска: длительность этапов обработки по корням и LevelOne,
+    счетчики строк и объектов, задержки, объемы и ошибки HTTP запросов по типам запросов.
+    В конце запуска метрики сохраняются в json файл в каталоге logs_path.
+    """
+    # границы корзин гистограммы задержек HTTP запросов, секунды
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    # текущие корень и LevelOne, к которым относятся метрики
+    CONTEXT = ('', '')
+    STARTED = datetime.now()
+    # {(root, level_one, phase): {'count': ..., 'seconds': ...}}
+    PHASES = {}
+    # {(root, level_one, name): value}
+    COUNTERS = {}
+    # {endpoint: {'count': ..., 'errors': ..., 'retries': ..., 'seconds': ..., 'bytes_in': ..., 'bytes_in_wire': ...,
+    #             'bytes_out': ..., 'bytes_out_saved': ..., 'buckets': [...]}}
+    HTTP = {}
+
+    @staticmethod
+    def set_context(root='', level_one=''):
+        Metrics.CONTEXT = (str(root), str(level_one))
+
+    @staticmethod
+    @contextmanager
+    def timer(phase):
+        """
+        Контекстный менеджер timer измеряет длительность этапа phase для текущих корня и LevelOne.
+
+        :param phase: Имя этапа
+        """
+        started = time.perf_counter()
+        try:
+            with Profiler.phase(phase):
+                yield
+        finally:
+            Metrics.add_time(phase, time.perf_counter() - started)
+
+    @staticmethod
+    def add_time(phase, seconds):
+        """Функция add_time добавляет длительность seconds этапа phase для текущих корня и LevelOne"""
+        phase_data = Metrics.PHASES.setdefault((*Metrics.CONTEXT, phase), {'count': 0, 'seconds': 0.0})
+        phase_data['count'] += 1
+        phase_data['seconds'] += seconds
+
+    @staticmethod
+    def reset():
+        """Функция reset начинает новый запуск метрик, в режиме --watch - для каждой загрузки"""
+        Metrics.CONTEXT = ('', '')
+        Metrics.STARTED = datetime.now()
+        Metrics.PHASES = {}
+        Metrics.COUNTERS = {}
+        Metrics.HTTP = {}
+
+    @staticmethod
+    def count(name, value=1):
+        """Функция count увеличивает счетчик name для текущих корня и LevelOne на value"""
+        key = (*Metrics.CONTEXT, name)
+        Metrics.COUNTERS[key] = Metrics.COUNTERS.get(key, 0) + value
+
+    @staticmethod
+    def get_endpoint(method, req_url):
+        """
+        Функция get_endpoint определяет тип запроса к API Neosintez по методу и адресу.
+
+        :param method: HTTP метод
+        :param req_url: Адрес запроса
+        :return: token, search, create, put, delete или other
+        """
+        method = method.upper()
+        if 'connect/token' in req_url:
+            return 'token'
+        elif 'api/objects/search' in req_url:
+            return 'search'
+        elif method == 'POST' and 'api/objects?' in req_url:
+            return 'create'
+        elif method == 'PUT' and req_url.endswith('/attributes'):
+            return 'put'
+        elif method == 'DELETE':
+            return 'delete'
+        return 'other'
+
+    @staticmethod
+    def get_http(endpoint):
+        return Metrics.HTTP.setdefault(endpoint, {
+            'count': 0,
+            'errors': 0,
+            'retries': 0,
+            'seconds': 0.0,
+            'bytes_in': 0,
+            'bytes_in_wire': 0,
+            'bytes_out': 0,
+            'bytes_out_saved': 0,
+            'buckets': [0] * (len(Metrics.LATENCY_BUCKETS) + 1),
+        })
+
+    @staticmethod
+    def response_hook(response, *args, **kwargs):
+        """
+        Функция response_hook подключается к сессии requests и учитывает каждый ответ API:
+        время до получения ответа, размер тела запроса и ответа, ошибки (код ответа 400 и выше).
+        Тело потокового ответа (stream=True) здесь не читается, его размер учитывает Metrics.stream_read.
+        """
+        http = Metrics.get_http(Metrics.get_endpoint(response.request.method, response.request.url))
+        seconds = response.elapsed.total_seconds()
+        http['count'] += 1
+        http['seconds'] += seconds
+        http['bytes_out'] += len(response.request.body or b'')
+        if not kwargs.get('stream'):
+            Metrics.stream_read(response, len(response.content))
+        if response.status_code >= 400:
+            http['errors'] += 1
+        bucket = len(Metrics.LATENCY_BUCKETS)
+        for i, bound in enumerate(Metrics.LATENCY_BUCKETS):
+            if seconds <= bound:
+                bucket = i
+                break
+        http['buckets'][bucket] += 1
+
+    @staticmethod
+    def stream_read(response, size):
+        """
+        Функция stream_read учитывает размер прочитанного тела ответа.
+
+        :param response: Объект ответа
+        :param size: Размер тела после распаковки, байт
+        """
+        http = Metrics.get_http(Metrics.get_endpoint(response.request.method, response.request.url))
+        http['bytes_in'] += size
+        # объем ответа по сети, для сжатых ответов меньше bytes_in
+        http['bytes_in_wire'] += response.raw.tell() if hasattr(response.raw, 'tell') else size
+
+    @staticmethod
+    def retry(endpoint):
+        """Функция retry учитывает повтор запроса типа endpoint"""
+        Metrics.get_http(endpoint)['retries'] += 1
+
+    @staticmethod
+    def peak_rss():
+        """
+        Функция peak_rss возвращает пиковый объем памяти процесса в байтах.
+        На Linux берется VmHWM из /proc/self/status, на других Unix - ru_maxrss, на Windows возвращается None.
+        """
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        try:
+            import resource
+        except ImportError:
+            return None
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    @staticmethod
+    def spurious_update_rate():
+        """
+        Функция spurious_update_rate возвращает долю ложных различий среди найденных в Neosintez строк с различиями:
+        строк, которые совпали только после приведения значений к каноническому виду (RowSchema.canonical).
+
+        :return: Доля от 0 до 1
+        """
+        spurious = sum(value for (_, _, name), value in Metrics.COUNTERS.items() if name == 'spurious_updates')
+        changed = sum(value for (_, _, name), value in Metrics.COUNTERS.items() if name == 'objects_changed')
+        return spurious / (spurious + changed) if spurious + changed else 0.0
+
+    @staticmethod
+    def summary():
+        """
+        Функция summary формирует сводку метрик запуска.
+
+        :return: Словарь, пригодный для сериализации в json
+        """
+        finished = datetime.now()
+        http = {}
+        for endpoint, data in Metrics.HTTP.items():
+            http[endpoint] = dict(data)
+            http[endpoint]['buckets'] = dict(zip([str(b) for b in Metrics.LATENCY_BUCKETS] + ['+Inf'], data['buckets']))
+            http[endpoint]['bytes_saved'] = data['bytes_in'] - data['bytes_in_wire'] + data['bytes_out_saved']
+        return {
+            'mode': mode,
+            'config': config_file_name_suffix,
+            'spurious_update_rate': Metrics.spurious_update_rate(),
+            'started': Metrics.STARTED.isoformat(timespec='seconds'),
+            'finished': finished.isoformat(timespec='seconds'),
+            'seconds': (finished - Metrics.STARTED).total_seconds(),
+            'peak_rss': Metrics.peak_rss(),
+            'phases': [
+                {'root': root, 'level_one': level_one, 'phase': phase, **data}
+                for (root, level_one, phase), data in Metrics.PHASES.items()
+            ],
+            'counters': [
+                {'root': root, 'level_one': level_one, 'name': name, 'value': value}
+                for (root, level_one, name), value in Metrics.COUNTERS.items()
+            ],
+            'http': http,
+        }
+
+    @staticmethod
+    def save_summary():
+        """Функция save_summary сохраняет сводку метрик запуска в json файл в каталоге logs_path"""
+        file_name = get_run_file_name('summary.json')
+        with open(file_name, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(Metrics.summary(), ensure_ascii=False, indent=1))
+        return file_name
+
+    @staticmethod
+    def _prometheus_labels(**labels):
+        escaped = []
+        for name, value in labels.items():
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            escaped.append(f'{name}="{value}"')
+        return '{' + ','.join(escaped) + '}'
+
+    @staticmethod
+    def save_prometheus(file_name):
+        """
+        Функция save_prometheus сохраняет метрики запуска в текстовом формате Prometheus
+        для сбора через textfile collector node exporter.
+        Файл записывается во временный файл и затем заменяется целиком, чтобы коллектор не прочитал его частично.
+
+        :param file_name: Путь к файлу метрик
+        """
+        base = {'mode': mode, 'config': config_file_name_suffix}
+        lines = []
+
+        def add_header(name, help_text, metric_type):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+
+        def add_sample(name, labels, value):
+            lines.append(f'{name}{Metrics._prometheus_labels(**base, **labels)} {value}')
+
+        def add(name, help_text, samples):
+            add_header(name, help_text, 'gauge')
+            for labels, value in samples:
+                add_sample(name, labels, value)
+
+        summary = Metrics.summary()
+        add('neosintez_import_last_run_timestamp_seconds', 'Time when the last run finished.',
+            [({}, datetime.now().timestamp())])
+        add('neosintez_import_run_seconds', 'Duration of the last run.', [({}, summary['seconds'])])
+        add('neosintez_import_spurious_update_rate', 'Share of changed rows that are equal after value normalization.',
+            [({}, summary['spurious_update_rate'])])
+
+        counters = {}
+        for (root, level_one, name), value in Metrics.COUNTERS.items():
+            counters.setdefault(name, []).append(({'root': root, 'level_one': level_one}, value))
+        for name, samples in counters.items():
+            add(f'neosintez_import_{name}', f'Counter {name} of the last run.', samples)
+
+        add('neosintez_import_phase_seconds', 'Duration of processing phases of the last run.',
+            [({'root': root, 'level_one': level_one, 'phase': phase}, data['seconds'])
+             for (root, level_one, phase), data in Metrics.PHASES.items()])
+
+        http = Metrics.HTTP.items()
+        add('neosintez_import_http_requests', 'HTTP requests of the last run.',
+            [({'endpoint': endpoint}, data['count']) for endpoint, data in http])
+        add('neosintez_import_http_errors', 'HTTP responses with status 400 and above.',
+            [({'endpoint': endpoint}, data['errors']) for endpoint, data in http])
+        add('neosintez_import_http_error_ratio', 'Share of HTTP responses with status 400 and above.',
+            [({'endpoint': endpoint}, data['errors'] / data['count'] if data['count'] else 0) for endpoint, data in http])
+        add('neosintez_import_http_retries', 'Retried HTTP requests.',
+            [({'endpoint': endpoint}, data['retries']) for endpoint, data in http])
+        add('neosintez_import_http_seconds', 'Total HTTP latency.',
+            [({'endpoint': endpoint}, data['seconds']) for endpoint, data in http])
+        add('neosintez_import_http_bytes_in', 'Decoded HTTP response bytes.',
+            [({'endpoint': endpoint}, data['bytes_in']) for endpoint, data in http])
+        add('neosintez_import_http_bytes_in_wire', 'HTTP response bytes received over the network.',
+            [({'endpoint': endpoint}, data['bytes_in_wire']) for endpoint, data in http])
+        add('neosintez_import_http_bytes_out', 'HTTP request bytes sent over the network.',
+            [({'endpoint': endpoint}, data['bytes_out']) for endpoint, data in http])
+        add('neosintez_import_http_bytes_saved', 'HTTP bytes saved by compression.',
+            [({'endpoint': endpoint}, data['bytes_in'] - data['bytes_in_wire'] + data['bytes_out_saved'])
+             for endpoint, data in http])
+        add_header('neosintez_import_http_latency', 'HTTP latency histogram, seconds.', 'histogram')
+        for endpoint, data in http:
+            cumulative = 0
+            for bound, bucket_count in zip([str(b) for b in Metrics.LATENCY_BUCKETS] + ['+Inf'], data['buckets']):
+                cumulative += bucket_count
+                add_sample('neosintez_import_http_latency_bucket', {'endpoint': endpoint, 'le': bound}, cumulative)
+            add_sample('neosintez_import_http_latency_sum', {'endpoint': endpoint}, data['seconds'])
+            add_sample('neosintez_import_http_latency_count', {'endpoint': endpoint}, cumulative)
+
+        tmp_file_name = file_name + '.tmp'
+        with open(tmp_file_name, 'w', encoding='utf-8', newline='\n') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_file_name, file_name)
+
+
+class Profiler:
+    """
+    Класс Profiler профилирует этапы обработки при запуске с флагом --profile.
+    Для каждого этапа верхнего уровня ведется отдельный cProfile, результаты сохраняются в .prof файлы в каталоге logs_path
+    (просмотр - snakeviz, flameprof, pstats). С флагом --profile-memory дополнительно через tracemalloc
+    фиксируется пиковая память этапов MEMORY_PHASES и разница снимков памяти до и после этапа.
+    """
+    ENABLED = False
+    MEMORY = False
+    # этапы, для которых фиксируется пиковая память
+    MEMORY_PHASES = ('read_excel', 'get_current_items_data', 'get_update_data', 'get_delete_items')
+    # {phase: cProfile.Profile}
+    PROFILES = {}
+    # этап, который профилируется в данный момент; вложенные этапы входят в его профиль
+    ACTIVE = None
+    # {phase: {'peak': ..., 'diff': [...]}}
+    MEMORY_STATS = {}
+
+    @staticmethod
+    def start(memory=False):
+        Profiler.ENABLED = True
+        Profiler.MEMORY = memory
+        if memory:
+            tracemalloc.start()
+
+    @staticmethod
+    @contextmanager
+    def phase(name):
+        """
+        Контекстный менеджер phase профилирует этап name, если профилирование включено.
+
+        :param name: Имя этапа
+        """
+        if not Profiler.ENABLED:
+            yield
+            return
+
+        profile = None
+        if Profiler.ACTIVE is None:
+            Profiler.ACTIVE = name
+            profile = Profiler.PROFILES.setdefault(name, cProfile.Profile())
+        snapshot = None
+        if Profiler.MEMORY and name in Profiler.MEMORY_PHASES:
+            tracemalloc.reset_peak()
+            snapshot = tracemalloc.take_snapshot()
+        if profile:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile:
+                profile.disable()
+                Profiler.ACTIVE = None
+            if snapshot:
+                Profiler._save_memory_stats(name, snapshot)
+
+    @staticmethod
+    def _save_memory_stats(name, snapshot):
+        """
+        Функция _save_memory_stats запоминает пиковую память этапа name
+        и разницу снимков памяти для вызова этапа с наибольшим пиком.
+        """
+        peak = tracemalloc.get_traced_memory()[1]
+        stats = Profiler.MEMORY_STATS.get(name)
+        if stats and stats['peak'] >= peak:
+            return
+        diff = tracemalloc.take_snapshot().compare_to(snapshot, 'lineno')[:20]
+        Profiler.MEMORY_STATS[name] = {
+            'peak': peak,
+            'context': Metrics.CONTEXT,
+            'diff': [str(stat) for stat in diff],
+        }
+
+    @staticmethod
+    def save():
+        """
+        Функция save сохраняет профили этапов и отчет по памяти в каталог logs_path.
+
+        :return: Список сохраненных файлов
+        """
+        files = []
+        for name, profile in Profiler.PROFILES.items():
+            file_name = get_run_file_name(f'{name}.prof')
+            profile.dump_stats(file_name)
+            files.append(file_name)
+        if Profiler.MEMORY_STATS:
+            file_name = get_run_file_name('memory.txt')
+            with open(file_name, 'w', encoding='utf-8') as f:
+                for name, stats in Profiler.MEMORY_STATS.items():
+                    f.write(f'{name}: peak {stats["peak"] / 1024 / 1024:.1f} MiB, root {stats["context"][0]}, '
+                            f'level one {stats["context"][1]}\n')
+                    for line in stats['diff']:
+                        f.write(f'    {line}\n')
+                    f.write('\n')
+            files.append(file_name)
+        return files
+
+
+class CassetteMissError(requests.RequestException):
+    """Исключение, если для запроса нет записанного ответа в кассете"""
+
+
+class CassetteAdapter(HTTPAdapter):
+    """
+    Транспорт сессии requests для записи и воспроизведения запросов к API Neosintez.
+    В режиме записи (--record) каждый запрос выполняется на сервере, а запрос и ответ сохраняются в кассету.
+    В режиме воспроизведения (--replay) ответы выдаются из кассеты без обращения к серверу,
+    с исходной задержкой, умноженной на cassette_latency_scale.
+    Запрос в кассете определяется методом, адресом относительно url и хэшем тела. Учетные данные из запроса
+    токена и сам токен в кассету не попадают.
+    Кассета - сжатый gzip файл, одна строка json на запрос.
+    Тело потокового ответа (stream=True) не читается при записи: оно копируется в кассету по мере чтения
+    вызывающей функцией (см. CassetteStream), поэтому в кассету попадает только прочитанная часть тела.
+    """
+    RECORD = 'record'
+    REPLAY = 'replay'
+
+    def __init__(self, cassette_mode, file_name, latency_scale=1.0, **kwargs):
+        super().__init__(**kwargs)
+        self.cassette_mode = cassette_mode
+        self.file_name = file_name
+        self.latency_scale = latency_scale
+        self.records = []
+        self.replay_records = {}
+        self.misses = 0
+        if cassette_mode == self.REPLAY:
+            with gzip.open(file_name, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    record = json.loads(line)
+                    self.replay_records.setdefault(self._key(record), deque()).append(record)
+
+    @staticmethod
+    def _key(record):
+        return record['method'], record['path'], record['body_hash']
+
+    @staticmethod
+    def _describe(request):
+        path = request.url[len(url):] if request.url.startswith(url) else request.url
+        body = request.body or b''
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if 'connect/token' in path:
+            body = b''
+        return {
+            'method': request.method,
+            'path': path,
+            'body_hash': hashlib.sha1(body).hexdigest(),
+        }
+
+    def send(self, request, **kwargs):
+        if self.cassette_mode == self.REPLAY:
+            return self._replay(request)
+
+        response = super().send(request, **kwargs)
+        record = self._describe(request)
+        record.update({
+            'status': response.status_code,
+            'headers': {name: value for name, value in response.headers.items()
+                        if name.lower() in ('content-type', 'retry-after')},
+            'elapsed': response.elapsed.total_seconds(),
+        })
+        self.records.append(record)
+        if kwargs.get('stream'):
+            # части тела собираются по мере чтения и объединяются в save
+            record['content'] = []
+            response.raw = CassetteStream(response.raw, record['content'])
+            return response
+
+        content = response.content
+        if 'connect/token' in request.url and response.status_code == 200:
+            token_response = json.loads(content)
+            token_response['access_token'] = 'REDACTED'
+            content = json.dumps(token_response).encode('utf-8')
+        record['content'] = content.decode('utf-8', errors='replace')
+        return response
+
+    def _replay(self, request):
+        record_key = self._key(self._describe(request))
+        queue = self.replay_records.get(record_key)
+        if not queue:
+            self.misses += 1
+            raise CassetteMissError(f'No recorded response for {request.method} {request.url}', request=request)
+        # последний ответ на повторяющийся запрос используется для всех следующих повторов
+        record = queue.popleft() if len(queue) > 1 else queue[0]
+        if self.latency_scale:
+            time.sleep(record['elapsed'] * self.latency_scale)
+
+        content = record['content'].encode('utf-8')
+        response = requests.Response()
+        response.status_code = record['status']
+        response.headers = CaseInsensitiveDict(record['headers'])
+        response.raw = io.BytesIO(content)
+        response.url = request.url
+        response.request = request
+        response.encoding = 'utf-8'
+        response.elapsed = timedelta(seconds=record['elapsed'])
+        response.connection = self
+        return response
+
+    def save(self):
+        """Функция save сохраняет записанные запросы в файл кассеты"""
+        with gzip.open(self.file_name, 'wt', encoding='utf-8') as f:
+            for record in self.records:
+                if isinstance(record['content'], list):
+                    record = dict(record, content=b''.join(record['content']).decode('utf-8', errors='replace'))
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+class CassetteStream:
+    """
+    Обертка тела потокового ответа в режиме записи кассеты: прочитанные вызывающей функцией части тела
+    копируются в список chunks. Остальные атрибуты берутся из исходного тела ответа.
+
+    :param raw: Тело ответа urllib3
+    :param chunks: Список частей тела в записи кассеты
+    """
+
+    def __init__(self, raw, chunks):
+        self.raw = raw
+        self.chunks = chunks
+
+    def stream(self, amt=2 ** 16, decode_content=None):
+        for chunk in self.raw.stream(amt, decode_content=decode_content):
+            self.chunks.append(chunk)
+            yield chunk
+
+    def read(self, *args, **kwargs):
+        data = self.raw.read(*args, **kwargs)
+        self.chunks.append(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+class NeosintezUnavailableError(requests.RequestException):
+    """Исключение при открытом автомате отключения запросов к API Neosintez"""
+
+
+class AdaptiveRateLimiter:
+    """
+    Адаптивный ограничитель частоты запросов к API по схеме AIMD.
+    После каждого успешного ответа допустимая частота увеличивается на increase запросов в секунду,
+    после ответа о перегрузке сервера (429, 5xx, таймаут) уменьшается в decrease раз.
+    Перед запросом выдерживается пауза так, чтобы частота запросов не превышала текущий предел.
+    Без max_rate ограничение включается только после первой перегрузки, начиная с фактической частоты запросов.
+
+    :param max_rate: Начальная и максимальная частота, запросов в секунду, 0 - без верхнего предела
+    :param min_rate: Минимальная частота, запросов в секунду
+    :param increase: Прирост частоты после успешного ответа
+    :param decrease: Коэффициент снижения частоты после перегрузки
+    """
+
+    def __init__(self, max_rate, min_rate=1.0, increase=1.0, decrease=0.5):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.rate = max_rate or None
+        self.next_time = 0.0
+        # время последних запросов для оценки фактической частоты
+        self.request_times = deque(maxlen=20)
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.request_times.append(now)
+            if self.rate is None:
+                return
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + 1 / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def on_success(self):
+        with self.lock:
+            if self.rate is not None:
+                self.rate = self.rate + self.increase
+                if self.max_rate:
+                    self.rate = min(self.max_rate, self.rate)
+
+    def on_overload(self):
+        with self.lock:
+            rate = self.rate
+            if rate is None:
+                span = self.request_times[-1] - self.request_times[0] if len(self.request_times) > 1 else 0
+                rate = (len(self.request_times) - 1) / span if span else self.min_rate
+            self.rate = max(self.min_rate, rate * self.decrease)
+
+
+class CircuitBreaker:
+    """
+    Автомат отключения запросов к API.
+    После threshold неудачных попыток подряд автомат открывается, и в течение timeout секунд запросы не выполняются.
+    После паузы выполняется одна пробная попытка: при успехе автомат закрывается, при неудаче снова открывается.
+
+    :param threshold: Число неудачных попыток подряд
+    :param timeout: Пауза, секунды
+    """
+
+    def __init__(self, threshold, timeout):
+        self.threshold = threshold
+        self.timeout = timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def check(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.timeout:
+                raise NeosintezUnavailableError(f'Neosintez API is unavailable after {self.failures} failed attempts')
+            # пробная попытка после паузы
+            self.opened_at = None
+            self.failures = self.threshold - 1
+
+    def on_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def on_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold and self.opened_at is None:
+                self.opened_at = time.monotonic()
+                logging.warning(f'Neosintez API circuit breaker is open for {self.timeout} s')
+
+
 class Neosintez:
+    __slots__ = ()
     TOKEN = None
+    # время окончания действия токена по time.monotonic, см. refresh_token
+    TOKEN_EXPIRES = None
     ROOTS = []
     SESSION = None
+    # транспорт записи и воспроизведения запросов, см. CassetteAdapter
+    CASSETTE = None
+    # ограничитель частоты и автомат отключения запросов, см. Neosintez.request
+    LIMITER = None
+    BREAKER = None
+    # коды ответа, после которых запрос повторяется
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    # сжатие тела больших PUT запросов, отключается, если сервер его не принимает
+    GZIP_REQUESTS = False
+    # создание объекта сразу с атрибутами одним запросом, None - поддержка сервером еще не проверена
+    CREATE_WITH_ATTRIBUTES = None
+    # id найденных значений ссылочных атрибутов по (папка, класс, имя), см. ref_atr
+    REFERENCES = {}
+
+    @staticmethod
+    def _get_retry_after(response):
+        """Функция _get_retry_after возвращает паузу из заголовка Retry-After в секундах или None"""
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if not retry_after:
+            return None
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+        try:
+            retry_date = parsedate_to_datetime(retry_after)
+            return max(0.0, (retry_date - datetime.now(tz=retry_date.tzinfo)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def request(method, req_url, idempotent=True, **kwargs):
+        """
+        Функция request выполняет запрос к API Neosintez через общую сессию.
+        Частота запросов ограничивается Neosintez.LIMITER, при ответах 429 и 5xx, ошибках соединения и таймаутах
+        запрос повторяется до retry_count раз с экспоненциальной паузой со случайной составляющей
+        либо с паузой из заголовка Retry-After. Неидемпотентные запросы (создание объекта) повторяются
+        только если сервер не начинал их обработку: при 429 и таймауте установки соединения,
+        в остальных случаях ответ с ошибкой возвращается вызывающей функции.
+        Если ошибки продолжаются после всех повторов, вызывается исключение.
+
+        :param method: HTTP метод
+        :param req_url: Адрес запроса
+        :param idempotent: Запрос можно безопасно повторить
+        :param kwargs: Параметры requests
+        :return: Объект ответа
+        """
+        endpoint = Metrics.get_endpoint(method, req_url)
+        kwargs.setdefault('timeout', (http_connect_timeout, http_read_timeout))
+        data = kwargs.get('data')
+        compressed = False
+        if Neosintez.GZIP_REQUESTS and method == 'PUT' and data and len(data) >= gzip_request_min_size:
+            raw_data = data.encode('utf-8') if isinstance(data, str) else data
+            kwargs['data'] = gzip.compress(raw_data, mtime=0)
+            kwargs['headers'] = dict(kwargs.get('headers') or {}, **{'Content-Encoding': 'gzip'})
+            Metrics.get_http(endpoint)['bytes_out_saved'] += len(raw_data) - len(kwargs['data'])
+            compressed = True
+        attempt = 0
+        while True:
+            Neosintez.BREAKER.check()
+            Neosintez.LIMITER.acquire()
+            response = None
+            error = None
+            try:
+                response = Neosintez.SESSION.request(method, req_url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+
+            if compressed and error is None and response.status_code in (400, 415):
+                # сервер не принимает сжатое тело запроса
+                logging.warning(f'Compressed request body is rejected ({response.status_code}), compression is disabled')
+                Neosintez.GZIP_REQUESTS = False
+                kwargs['data'] = data
+                kwargs['headers'] = {k: v for k, v in kwargs['headers'].items() if k != 'Content-Encoding'}
+                compressed = False
+                continue
+            if error is None and response.status_code not in Neosintez.RETRY_STATUSES:
+                Neosintez.LIMITER.on_success()
+                Neosintez.BREAKER.on_success()
+                return response
+
+            Neosintez.LIMITER.on_overload()
+            Neosintez.BREAKER.on_failure()
+            retryable = idempotent or isinstance(error, requests.ConnectTimeout) or (
+                    response is not None and response.status_code == 429)
+            if error is not None and (not retryable or attempt >= retry_count):
+                raise error
+            elif not retryable:
+                return response
+            elif attempt >= retry_count:
+                response.raise_for_status()
+
+            pause = random.uniform(0, min(retry_backoff_max, retry_backoff * 2 ** attempt))
+            retry_after = Neosintez._get_retry_after(response)
+            if retry_after is not None:
+                # сервер сам назначил паузу: она выдерживается целиком, retry_backoff_max ее не ограничивает
+                pause = max(pause, min(retry_after, retry_after_max))
+            reason = error if error is not None else response.status_code
+            logging.warning(f'Request {method} {req_url} failed ({reason}), retry {attempt + 1} in {pause:.1f} s')
+            Metrics.retry(endpoint)
+            if response is not None:
+                response.close()
+            time.sleep(pause)
+            attempt += 1
+
+    @staticmethod
+    def iter_search_objects(response, chunk_size=65536, page=None):
+        """
+        Функция iter_search_objects построчно разбирает ответ поискового запроса, полученный с stream=True.
+        Тело читается из сетевого потока частями по chunk_size байт, и объекты Result[i].Object
+        выдаются по одному, поэтому в памяти одновременно находится только часть ответа.
+        Остальные ключи ответа пропускаются, Total сохраняется в page, если он передан.
+
+        :param response: Объект ответа api/objects/search
+        :param chunk_size: Размер части тела, байт
+        :param page: Словарь, в который после разбора ответа записывается Total - число найденных объектов
+        :return: Генератор словарей Object
+        """
+        response.raise_for_status()
+        decoder = json.JSONDecoder()
+        text_decoder = codecs.getincrementaldecoder('utf-8')()
+        chunks = response.iter_content(chunk_size)
+        state = {'buffer': '', 'pos': 0, 'eof': False, 'size': 0}
+
+        def fill():
+            chunk = next(chunks, None)
+            if chunk is None:
+                if state['eof']:
+                    raise ValueError(f'Unexpected end of search response {response.url}')
+                state['eof'] = True
+                text = text_decoder.decode(b'', final=True)
+            else:
+                state['size'] += len(chunk)
+                text = text_decoder.decode(chunk)
+            state['buffer'] = state['buffer'][state['pos']:] + text
+            state['pos'] = 0
+
+        def peek():
+            # следующий значимый символ без пробелов
+            while True:
+                buffer, pos = state['buffer'], state['pos']
+                while pos < len(buffer) and buffer[pos] in ' \t\r\n':
+                    pos += 1
+                state['pos'] = pos
+                if pos < len(buffer):
+                    return buffer[pos]
+                fill()
+
+        def value():
+            # значение JSON целиком; число в конце буфера может быть неполным, поэтому нужен следующий символ
+            peek()
+            while True:
+                try:
+                    result, end = decoder.raw_decode(state['buffer'], state['pos'])
+                    if end < len(state['buffer']) or state['eof']:
+                        state['pos'] = end
+                        return result
+                except json.JSONDecodeError:
+                    if state['eof']:
+                        raise
+                fill()
+
+        def expect(char):
+            if peek() != char:
+                raise ValueError(f'Unexpected search response {response.url}: "{char}" expected')
+            state['pos'] += 1
+
+        try:
+            has_result = False
+            expect('{')
+            while peek() != '}':
+                if peek() == ',':
+                    state['pos'] += 1
+                    continue
+                key = value()
+                expect(':')
+                if key != 'Result':
+                    result = value()
+                    if key == 'Total' and page is not None:
+                        page['Total'] = result
+                    continue
+                has_result = True
+                expect('[')
+                while peek() != ']':
+                    if peek() == ',':
+                        state['pos'] += 1
+                        continue
+                    yield value()['Object']
+                state['pos'] += 1
+            if not has_result:
+                raise ValueError(f'Unexpected search response {response.url}: Result is not found')
+        finally:
+            Metrics.stream_read(response, state['size'])
+            response.close()
 
     @staticmethod
     def get_token():
@@ -22,6 +859,7 @@ class Neosintez:
         Функция использует библиотеку requests для выполнения POST-запроса к конечной точке /connect/token API Neosintez. 
         API Neosintez, передавая в качестве полезной нагрузки учетные данные, хранящиеся в файле auth_data.txt. 
         В случае успеха запрос сохраняет сессию и маркер доступа для использования другими функциями.
+        Сессия создается один раз, при повторном получении токена используется существующая.
         """
         with open(config_dict['auth_data_file']) as f:
             aut_string = f.read()
@@ -31,10 +869,30 @@ class Neosintez:
         headers = {
             'Content-Type': 'application/x-www-form-urlencoded'
         }
-        Neosintez.SESSION = requests.session()
-        response = Neosintez.SESSION.post(req_url, data=payload, headers=headers)
+        if Neosintez.SESSION is None:
+            Neosintez.SESSION = requests.session()
+            Neosintez.SESSION.hooks['response'].append(Metrics.response_hook)
+            Neosintez.SESSION.headers['Accept-Encoding'] = 'gzip, deflate'
+            adapter = Neosintez.CASSETTE or HTTPAdapter(pool_connections=http_pool_connections,
+                                                        pool_maxsize=http_pool_maxsize)
+            Neosintez.SESSION.mount('http://', adapter)
+            Neosintez.SESSION.mount('https://', adapter)
+        response = Neosintez.request('POST', req_url, data=payload, headers=headers)
         if response.status_code == 200:
-            Neosintez.TOKEN = json.loads(response.text)['access_token']
+            token = json.loads(response.text)
+            Neosintez.TOKEN = token['access_token']
+            Neosintez.TOKEN_EXPIRES = time.monotonic() + token.get('expires_in', 3600)
+
+    @staticmethod
+    def refresh_token(margin=60):
+        """
+        Функция refresh_token получает новый токен, если до окончания действия текущего осталось меньше margin секунд.
+
+        :param margin: Запас до окончания действия токена, секунды
+        """
+        if Neosintez.TOKEN_EXPIRES is None or time.monotonic() > Neosintez.TOKEN_EXPIRES - margin:
+            logging.info('Token is refreshed')
+            Neosintez.get_token()
 
     @staticmethod
     def get_id_by_name(parent_id, class_id, name, create=False):
@@ -77,7 +935,7 @@ class Neosintez:
             'Content-Type': 'application/json-patch+json',
             'X-HTTP-Method-Override': 'GET'
         }
-        response = Neosintez.SESSION.post(req_url, headers=headers, data=payload)
+        response = Neosintez.request('POST', req_url, headers=headers, data=payload)
         response = json.loads(response.text)
         if response['Total'] == 1:
             return response['Result'][0]['Object']['Id']
@@ -85,57 +943,85 @@ class Neosintez:
             logging.warning(f'More then one result is found fo {parent_id}, class id {class_id}, name {name}')
             return None
         elif create:
-            return Neosintez.create_in_neosintez(parent_id, class_id, name)
+            item_id = Neosintez.create_in_neosintez(parent_id, class_id, name)
+            if item_id:
+                Metrics.count('folders_created')
+            return item_id
         else:
             return ''
 
     @staticmethod
-    def create_in_neosintez(parent_id, class_id, name):
+    def create_in_neosintez(parent_id, class_id, name, request_body=None):
         """
         Функция create_in_neosintez создает объект в Neosintez.
+        Если передано тело запроса request_body, объект создается сразу с этими атрибутами одним запросом.
+        Первое такое создание проверяется поиском объекта по ключевому атрибуту. Если сервер не принимает
+        или игнорирует атрибуты при создании, они записываются отдельным запросом put_attributes,
+        и дальше объекты создаются в два запроса.
         
         :param parent_id: Родительский объект.
         :param class_id: Указывает класс создаваемого объекта
         :param name: бъект с указанным именем
+        :param request_body: Список атрибутов объекта в формате put_attributes
         :return: id созданного объекта
         """
 
         req_url = url + f'api/objects?parent={parent_id}'
-        payload = json.dumps({
+        payload = {
             "Id": "00000000-0000-0000-0000-000000000000",
             "Name": name,
             "Entity": {
                 "Id": class_id,
                 "Name": "forvalidation"
             }
-        })
+        }
         headers = {
             'Accept': 'application/json',
             'Authorization': f'Bearer {Neosintez.TOKEN}',
             'Content-Type': 'application/json-patch+json'
         }
-        response = Neosintez.SESSION.post(req_url, headers=headers, data=payload)  # создание объекта
+        with_attributes = bool(request_body) and create_with_attributes and Neosintez.CREATE_WITH_ATTRIBUTES is not False
+        if with_attributes:
+            attributes = {attribute['Id']: attribute for attribute in request_body}
+            response = Neosintez.request('POST', req_url, idempotent=False, headers=headers,
+                                         data=json.dumps(dict(payload, Attributes=attributes)))
+            if response.status_code == 400:
+                with_attributes = False
+        if not with_attributes:
+            response = Neosintez.request('POST', req_url, idempotent=False, headers=headers, data=json.dumps(payload))  # создание объекта
+            if response.status_code == 200 and request_body and Neosintez.CREATE_WITH_ATTRIBUTES is None and \
+                    create_with_attributes:
+                logging.warning('Object attributes are rejected on creation, objects are created in two requests')
+                Neosintez.CREATE_WITH_ATTRIBUTES = False
         response_text = json.loads(response.text)  # создание объекта с десериализацией ответа
-        if response.status_code == 200:
-            return response_text['Id']
-        else:
+        if response.status_code != 200:
             logging.warning(f'Item is not created {name} {response.status_code} {response.text}')
             return ''
 
+        item_id = response_text['Id']
+        if with_attributes and Neosintez.CREATE_WITH_ATTRIBUTES is None:
+            key = attributes.get(key_attribute_id)
+            if key and Neosintez.search_by_key(parent_id, class_id, key['Value'], key_attribute_id) == item_id:
+                Neosintez.CREATE_WITH_ATTRIBUTES = True
+            else:
+                logging.warning('Object attributes are ignored on creation, objects are created in two requests')
+                Neosintez.CREATE_WITH_ATTRIBUTES = False
+                with_attributes = False
+        if request_body and not with_attributes:
+            Neosintez.put_attributes(item_id, request_body)
+        return item_id
+
     @staticmethod
-    def get_id_by_key(parent_id, class_id, name, value, attribute_value_id):
-        """
-        Функция get_id_by_key используется для получения идентификатора объекта в Neosintez по его ключу.
-            Если объектов с таким ключом нет, то она создает один и возвращает его id.
-        
-        :param parent_id: Указывает родительский узел нового объекта
-        :param class_id: Указывает класс создаваемого объекта
-        :param name: Создание нового объекта в системе neosintez
-        :param value: Поиск значения в базе данных neosintez
-        :param attribute_value_id: Указываем атрибут, для которого ищем значение
-        :return: id элемента в neosintez
+    def search_by_key(parent_id, class_id, value, attribute_value_id):
         """
+        Функция search_by_key ищет объект в Neosintez по значению ключевого атрибута.
 
+        :param parent_id: Узел поиска
+        :param class_id: Класс объекта
+        :param value: Значение ключевого атрибута
+        :param attribute_value_id: Ключевой атрибут
+        :return: id объекта, None - если найдено несколько объектов, '' - если объект не найден
+        """
         req_url = url + 'api/objects/search?take=30'
         payload = json.dumps({
             "Filters": [
@@ -163,22 +1049,43 @@ class Neosintez:
             'Content-Type': 'application/json-patch+json',
             'X-HTTP-Method-Override': 'GET'
         }
-        response = Neosintez.SESSION.post(req_url, headers=headers, data=payload)
+        response = Neosintez.request('POST', req_url, headers=headers, data=payload)
         response_text = json.loads(response.text)
         if response.status_code == 200 and response_text['Total'] == 1:
             return response_text['Result'][0]['Object']['Id']
         elif response.status_code == 200 and response_text['Total'] > 1:
             return None
         else:
-            item_id = Neosintez.create_in_neosintez(parent_id, class_id, name)
-            request_body = [{
-                'Name': 'forvalidation',
-                'Value': value,
-                'Type': 2,
-                'Id': attribute_value_id
-            }]
-            Neosintez.put_attributes(item_id, request_body)
-            return item_id
+            return ''
+
+    @staticmethod
+    def get_key_request_body(value, attribute_value_id):
+        """Функция get_key_request_body возвращает тело запроса записи ключевого атрибута"""
+        return [{
+            'Name': 'forvalidation',
+            'Value': value,
+            'Type': 2,
+            'Id': attribute_value_id
+        }]
+
+    @staticmethod
+    def get_id_by_key(parent_id, class_id, name, value, attribute_value_id):
+        """
+        Функция get_id_by_key используется для получения идентификатора объекта в Neosintez по его ключу.
+            Если объектов с таким ключом нет, то она создает один и возвращает его id.
+        
+        :param parent_id: Указывает родительский узел нового объекта
+        :param class_id: Указывает класс создаваемого объекта
+        :param name: Создание нового объекта в системе neosintez
+        :param value: Поиск значения в базе данных neosintez
+        :param attribute_value_id: Указываем атрибут, для которого ищем значение
+        :return: id элемента в neosintez
+        """
+        item_id = Neosintez.search_by_key(parent_id, class_id, value, attribute_value_id)
+        if item_id == '':
+            item_id = Neosintez.create_in_neosintez(parent_id, class_id, name,
+                                                    Neosintez.get_key_request_body(value, attribute_value_id))
+        return item_id
 
     @staticmethod
     def put_attributes(item_id, request_body):
@@ -202,7 +1109,7 @@ class Neosintez:
             'Authorization': f'Bearer {Neosintez.TOKEN}',
             'Content-Type': 'application/json-patch+json'
         }
-        response = Neosintez.SESSION.put(req_url, headers=headers, data=payload)
+        response = Neosintez.request('PUT', req_url, headers=headers, data=payload)
         if response.status_code != 200:
             logging.warning(f'Put attributes error. Url {req_url}, body {request_body}, response {response.text}')
         return response
@@ -211,10 +1118,14 @@ class Neosintez:
     def get_roots_from_neosintez():
         """
         Функция get_roots_from_neosintez используется для получения корневых папок из Neosintez.
-        Функция не принимает аргументов и возвращает список объектов Root.
+        Корни запрашиваются постранично по search_page_size объектов и добавляются в Neosintez.ROOTS как объекты Root.
+
+        Если в конфиге задан roots_cache_ttl, разобранные корни сохраняются в roots_cache_file. Следующие запуски
+        берут корни из кэша без поиска, если кэшу меньше roots_cache_ttl секунд, конфиг не менялся
+        и число корней в Neosintez (поиск take=0) не изменилось. Изменение списка LevelOne корня
+        без изменения числа корней учитывается после истечения roots_cache_ttl.
+        При записи и воспроизведении кассеты кэш не используется.
         """
-        
-        req_url = url + 'api/objects/search?take=100'
         payload = json.dumps({
             "Filters": [
                 {
@@ -236,16 +1147,52 @@ class Neosintez:
             'Content-Type': 'application/json-patch+json',
             'X-HTTP-Method-Override': 'GET'
         }
-        response = json.loads(Neosintez.SESSION.post(req_url, headers=headers, data=payload).text)
-        for folder in response['Result']:
-            item_id = folder['Object']['Id']
-            keys_list = folder['Object']['Attributes'][config_attribute_id]['Value']
-            keys_list = keys_list.replace(' ', '')
-            keys_list = keys_list.split(';')
-            object_request_body = folder['Object']['Attributes'].get(object_attribute_id)
-            if object_request_body:
-                object_request_body = object_request_body['Value']
-
+        use_cache = roots_cache_ttl > 0 and Neosintez.CASSETTE is None
+        # после изменения конфига кэш не используется
+        cache_key = hashlib.sha256(json.dumps(config_dict, sort_keys=True).encode('utf-8')).hexdigest()
+        roots = None
+        if use_cache and os.path.isfile(roots_cache_file):
+            try:
+                with open(roots_cache_file, encoding='utf-8') as f:
+                    cache = json.loads(f.read())
+                cache_age = time.time() - cache['time']
+                if cache['key'] == cache_key and 0 <= cache_age < roots_cache_ttl:
+                    roots = cache['roots']
+            except (OSError, ValueError, KeyError, TypeError):
+                logging.warning(f'Roots cache {roots_cache_file} is broken and will be rebuilt')
+            if roots is not None:
+                req_url = url + 'api/objects/search?take=0'
+                response = json.loads(Neosintez.request('POST', req_url, headers=headers, data=payload).text)
+                if response['Total'] == len(roots):
+                    logging.info(f'Roots are taken from cache {roots_cache_file}, cache age {cache_age:.0f} s. '
+                                 f'Changes of root level one lists are loaded after {roots_cache_ttl} s')
+                else:
+                    roots = None
+
+        if roots is None:
+            roots = []
+            while True:
+                req_url = url + f'api/objects/search?take={search_page_size}&skip={len(roots)}'
+                response = json.loads(Neosintez.request('POST', req_url, headers=headers, data=payload).text)
+                for folder in response['Result']:
+                    item_id = folder['Object']['Id']
+                    keys_list = folder['Object']['Attributes'][config_attribute_id]['Value']
+                    keys_list = keys_list.replace(' ', '')
+                    keys_list = keys_list.split(';')
+                    object_request_body = folder['Object']['Attributes'].get(object_attribute_id)
+                    if object_request_body:
+                        object_request_body = object_request_body['Value']
+                    roots.append([item_id, keys_list, object_request_body])
+                if not response['Result'] or len(roots) >= response['Total']:
+                    break
+            if use_cache:
+                try:
+                    with open(roots_cache_file, 'w', encoding='utf-8') as f:
+                        f.write(json.dumps({'key': cache_key, 'time': time.time(), 'roots': roots}, ensure_ascii=False))
+                except OSError:
+                    logging.warning(f'Roots cache {roots_cache_file} is not saved')
+
+        for item_id, keys_list, object_request_body in roots:
             next_root = Root(item_id, keys_list, object_request_body)
             Neosintez.ROOTS.append(next_root)
 
@@ -277,12 +1224,17 @@ class Neosintez:
         :param *: Передача словаря параметров в функцию
         :param value: Передать значение из проверяемой ячейки.
         :param atr: Передать в функцию идентификатор папки и класса
-        :return: Словарь с ключами id и name
+        :return: Словарь с ключами id и name, id найденных значений запоминаются в REFERENCES
         """
         value = value.replace('.', '')
         folder_id = atr['folder']
         class_id = atr['class']
-        item_id = LevelOne.get_id_by_name(folder_id, class_id, value)
+        # найденные значения запоминаются на время запуска, ненайденные ищутся снова
+        item_id = Neosintez.REFERENCES.get((folder_id, class_id, value))
+        if item_id is None:
+            item_id = LevelOne.get_id_by_name(folder_id, class_id, value)
+            if item_id:
+                Neosintez.REFERENCES[(folder_id, class_id, value)] = item_id
         if item_id:
             return {'Id': item_id, 'Name': 'forvalidation'}
         else:
@@ -359,10 +1311,181 @@ class Root(Neosintez):
     #         next_level_one.push_into_neosintez()
 
 
+class RowSchema:
+    """
+    Схема компактных строк данных LevelOne.
+    Строки new_data и update_data - кортежи значений колонок columns: колонок мэпинга (для атрибутов
+    с регулярным выражением - regexp_name) и колонки второго уровня. Строки current_data - кортежи
+    значений колонок current_columns: id объекта и колонок мэпинга.
+    Колонка с одинаковым именем у нескольких атрибутов хранится один раз, значение дает последний атрибут мэпинга.
+
+    :param mapping_data: Мэпинг атрибутов
+    :param level_two_column: Имя колонки второго уровня
+    :param key_column: Имя ключевой колонки
+    """
+
+    def __init__(self, mapping_data, level_two_column, key_column):
+        names = [attribute['regexp_name'] if attribute['regexp'] else attribute['name'] for attribute in mapping_data]
+        self.mapping_columns = tuple(dict.fromkeys(names))
+        self.columns = self.mapping_columns
+        if level_two_column not in self.columns:
+            self.columns += (level_two_column,)
+        self.current_columns = ('id',) + self.mapping_columns
+        self.index = {name: i for i, name in enumerate(self.columns)}
+        self.current_index = {name: i for i, name in enumerate(self.current_columns)}
+        # позиции значений атрибутов мэпинга в строках new_data и current_data, в порядке мэпинга
+        self.new_positions = [self.index[name] for name in names]
+        self.current_positions = [self.current_index[name] for name in names]
+        # позиции колонок attribute['name'] для тела запроса записи атрибутов, None - колонки нет
+        self.request_positions = [self.index.get(attribute['name']) for attribute in mapping_data]
+        self.level_two_position = self.index[level_two_column]
+        self.key_position = self.index[key_column]
+        self.current_key_position = self.current_index[key_column]
+        # строки сравниваются по колонкам мэпинга без колонки 'Папка', и только если набор колонок совпадает
+        self.comparable = set(self.columns) - {'Папка'} == set(self.mapping_columns)
+        # типы атрибутов колонок мэпинга для приведения значений к каноническому виду
+        column_types = {}
+        for name, attribute in zip(names, mapping_data):
+            column_types[name] = attribute['type']
+        self.mapping_types = tuple(column_types[name] for name in self.mapping_columns)
+        self.key_type = column_types.get(key_column, 2)
+
+    def same(self, new_row, current_row):
+        """
+        Функция same сравнивает строку new_data со строкой current_data без учета id и колонки 'Папка'.
+
+        :return: True, если значения колонок совпадают
+        """
+        return self.comparable and new_row[:len(self.mapping_columns)] == current_row[1:]
+
+    def same_canonical(self, new_row, current_row):
+        """
+        Функция same_canonical сравнивает строки как same, но значения колонок предварительно приводятся
+        к каноническому виду по типу атрибута, см. canonical.
+
+        :return: True, если канонические значения колонок совпадают
+        """
+        if not self.comparable:
+            return False
+        canonical = self.canonical
+        return all(canonical(new_value, atr_type) == canonical(current_value, atr_type)
+                   for new_value, current_value, atr_type in zip(new_row, current_row[1:], self.mapping_types))
+
+    @staticmethod
+    def canonical(value, atr_type):
+        """
+        Функция canonical приводит значение атрибута к виду, в котором одинаковые значения из excel-файла
+        и из Neosintez совпадают: пустая строка и NaN - None, для чисел (тип 1) - float, в том числе из строк,
+        с округлением до 9 знаков, для остальных типов - строка без пробелов по краям, целые float без дробной части,
+        для ссылок (тип 8) без точек, для дат (типы 3 и 5) без времени.
+
+        :param value: Значение
+        :param atr_type: Тип атрибута
+        :return: Каноническое значение
+        """
+        if value is None or value != value:
+            return None
+        if atr_type == 1 and not isinstance(value, bool):
+            if isinstance(value, str):
+                try:
+                    value = float(value.strip().replace(' ', '').replace(',', '.'))
+                except ValueError:
+                    return value.strip() or None
+            if isinstance(value, (int, float)):
+                return round(float(value), 9)
+            return value
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        if not isinstance(value, str):
+            value = str(value)
+        if atr_type == 8:
+            value = value.replace('.', '')
+        elif atr_type == 3 or atr_type == 5:
+            value = value.split('T')[0]
+        return value.strip() or None
+
+    def same_new(self, first_row, second_row):
+        """
+        Функция same_new сравнивает две строки new_data: колонки мэпинга по каноническим значениям, остальные колонки как есть.
+
+        :return: True, если строки совпадают
+        """
+        canonical = self.canonical
+        mapping_count = len(self.mapping_columns)
+        return first_row[mapping_count:] == second_row[mapping_count:] and all(
+            canonical(first_value, atr_type) == canonical(second_value, atr_type)
+            for first_value, second_value, atr_type in zip(first_row, second_row, self.mapping_types))
+
+    def new_key(self, row):
+        """Функция new_key возвращает канонический ключ строки new_data для сопоставления со строками current_data"""
+        return self.canonical(row[self.key_position], self.key_type)
+
+    def current_key(self, row):
+        """Функция current_key возвращает канонический ключ строки current_data"""
+        return self.canonical(row[self.current_key_position], self.key_type)
+
+    def get(self, row, name):
+        """Функция get возвращает значение колонки name строки new_data или None, если такой колонки нет"""
+        position = self.index.get(name)
+        return None if position is None else row[position]
+
+    def get_current(self, row, name):
+        """Функция get_current возвращает значение колонки name строки current_data или None, если такой колонки нет"""
+        position = self.current_index.get(name)
+        return None if position is None else row[position]
+
+
 class LevelOne(Neosintez):
     """
     Этот класс представляет собой экземпляр LevelOne в системе Neosintez.
     """
+    # мэпинг атрибутов, общий для всех экземпляров LevelOne, и дата изменения attributes_file, из которого он загружен
+    MAPPING_DATA = None
+    MAPPING_MTIME = None
+    # префиксы имен файлов выгрузки по режимам
+    FILE_PREFIX = {
+        'appius': 'РД',
+        'mto': 'ЗО',
+        'delivery_order': 'Д',
+        'notification': 'У',
+    }
+    # планы изменений в режиме --plan
+    PLANS = []
+    # индекс каталога files_directory и сгруппированные по (имя LevelOne, префикс) файлы
+    FILES_INDEX = None
+    FILES_GROUPS = {}
+    # пары (id атрибута, имя колонки) из мэпинга для разбора ответа поиска
+    MAPPED_ATTRIBUTES = None
+    # поддержка сервером отбора атрибутов в поисковом запросе, None - еще не проверена
+    PROJECTION_SUPPORTED = None
+    # схема строк new_data, update_data и current_data, см. RowSchema
+    SCHEMA = None
+    # строки current_data последнего корня по именам LevelOne в режиме mto, см. get_root_partitions
+    ROOT_PARTITIONS = {}
+    # колонки файлов выгрузки, которые _read_excel использует помимо колонок мэпинга, по режимам
+    EXCEL_MODE_COLUMNS = {
+        'appius': ('Обозначение', 'Изм.', '№ поз. по ГП'),
+        'mto': ('Код (НСИ)', 'Потребность.Номер', 'Потребность.Этап согласования', 'Номер спецификации (РД)',
+                'Номер и дата служебной записки'),
+        'delivery_order': ('Документ заказа.Номер', 'Потребность.Номенклатура.Код', 'Потребность.Номер'),
+        'notification': ('Потребность.Номенклатура.Код', 'Потребность.Номер', 'Плановая дата прихода на склад',
+                         'Дата отгрузки'),
+    }
+    # колонки файла выгрузки, которые читает _read_excel, см. get_excel_columns
+    EXCEL_COLUMNS = None
+    # пул процессов разбора файлов выгрузки и задания разбора по путям файлов, см. start_parsing
+    EXECUTOR = None
+    PARSE_FUTURES = {}
+    # файлы для разбора в порядке обработки (путь, имя LevelOne), их позиции, позиция следующего файла для отправки
+    # в пул и число файлов, которые разбираются впереди обрабатываемого, см. submit_parsing
+    PARSE_PATHS = []
+    PARSE_POSITIONS = {}
+    PARSE_NEXT = 0
+    PARSE_AHEAD = 0
+    # поток переноса обработанных файлов в prev и его задания, см. delete_file
+    ARCHIVER = None
+    ARCHIVE_FUTURES = []
+
     def __init__(self, name, parent, object_request_body):
         """
         Инициализирует новый экземпляр LevelOne.
@@ -380,29 +1503,165 @@ class LevelOne(Neosintez):
         self.current_data = None
         self.update_data = None
         self.delete_items_id = None
+        # ключи повторяющихся в файле строк с разными значениями, см. coalesce_new_data
+        self.conflicts = []
+        # строки current_data по каноническому ключу (для дублей - оставляемый объект), id оставляемых дублей
+        # по ключу и id остальных дублей, см. resolve_doubles
+        self.current_by_key = None
+        self.survivors = {}
+        self.double_items_id = set()
+        # число удаленных и добавленных (созданных или перенесенных из других LevelOne) объектов
+        # для расчета total_in_neosintez без запроса
+        self.deleted_count = 0
+        self.added_count = 0
         self.levels_two = {}
         self.f_path = ''
         self.f_prev_path = ''
-        self._mapping_data = None
+        # размер и время изменения файла при чтении, см. stage_file
+        self.f_stat = None
+        # объекты получаются общим поиском по корню, см. set_root_wide
+        self.root_wide = False
 
     @property
     def mapping_data(self):
         """
-        Функция mapping_data считывает файл attributes_file и возвращает список словарей.
+        Функция mapping_data возвращает список словарей мэпинга атрибутов из файла attributes_file.
         Каждый словарь содержит следующие ключи:
-            'Атрибут' - имя атрибута, например, 'Пол', 'Возраст' и т.д.
-            'id' - номер идентификатора для каждого атрибута, например, 1, 2, 3... и т.д.  Он используется для создания уникальных имен столбцов в кадре данных, возвращаемом функцией get_data().
-            'values' - список значений для каждого атрибута (например, ['муж
-        
+            'id' - идентификатор атрибута в Неосинтез;
+            'type' - тип атрибута (1 - число, 2 - строка, 3 и 5 - дата, 8 - ссылка);
+            'name' - имя колонки эксель файла;
+            'folder', 'class' - папка и класс справочника для ссылочных атрибутов;
+            'regexp', 'regexp_name' - регулярное выражение и имя колонки для извлекаемого значения.
+        Мэпинг общий для всех экземпляров LevelOne и загружается один раз за процесс функцией load_mapping_data.
+
         :param self: Экземпляр класса
         :return: Список словарей
         """
-        
-        if not self._mapping_data:
+        return self.load_mapping_data()
+
+    @staticmethod
+    def load_mapping_data():
+        """
+        Функция load_mapping_data загружает мэпинг атрибутов один раз за процесс (в режиме --watch - заново
+        после изменения attributes_file, см. reset_mapping_if_changed).
+        Результат разбора attributes_file сохраняется в файл кэша рядом с ним вместе с датой изменения эксель файла.
+        Если дата изменения не поменялась, мэпинг читается из кэша без разбора эксель файла.
+
+        :return: Список словарей
+        """
+        if LevelOne.MAPPING_DATA is not None:
+            return LevelOne.MAPPING_DATA
+
+        source_mtime = os.path.getmtime(attributes_file)
+        cache_file = os.path.splitext(attributes_file)[0] + '.cache.json'
+        mapping = None
+        if os.path.isfile(cache_file):
+            try:
+                with open(cache_file, encoding='utf-8') as f:
+                    cache = json.loads(f.read())
+                if cache['mtime'] == source_mtime:
+                    mapping = cache['mapping']
+            except (OSError, ValueError, KeyError):
+                logging.warning(f'Mapping cache {cache_file} is broken and will be rebuilt')
+
+        if mapping is None:
             mapping = pd.read_excel(attributes_file, sheet_name='Лист1').to_json(orient='records', force_ascii=False)
             mapping = json.loads(mapping)
-            self._mapping_data = mapping
-        return self._mapping_data
+            LevelOne._validate_mapping_data(mapping)
+            # кэш записывается во временный файл и затем заменяется целиком, чтобы другой процесс не прочитал его частично
+            tmp_cache_file = f'{cache_file}.{os.getpid()}.tmp'
+            try:
+                with open(tmp_cache_file, 'w', encoding='utf-8') as f:
+                    f.write(json.dumps({'mtime': source_mtime, 'mapping': mapping}, ensure_ascii=False))
+                os.replace(tmp_cache_file, cache_file)
+            except OSError:
+                logging.warning(f'Mapping cache {cache_file} is not saved')
+
+        LevelOne.MAPPING_DATA = mapping
+        LevelOne.MAPPING_MTIME = source_mtime
+        return mapping
+
+    @staticmethod
+    def reset_mapping_if_changed():
+        """
+        Функция reset_mapping_if_changed сбрасывает мэпинг и построенные по нему схему, колонки и шаблон тела запроса,
+        если attributes_file изменился после загрузки мэпинга. Используется в режиме --watch перед каждой загрузкой.
+
+        :return: True, если мэпинг сброшен
+        """
+        if LevelOne.MAPPING_DATA is None or os.path.getmtime(attributes_file) == LevelOne.MAPPING_MTIME:
+            return False
+        LevelOne.MAPPING_DATA = None
+        LevelOne.MAPPING_MTIME = None
+        LevelOne.MAPPED_ATTRIBUTES = None
+        LevelOne.SCHEMA = None
+        LevelOne.EXCEL_COLUMNS = None
+        Item.TEMPLATE = None
+        return True
+
+    @staticmethod
+    def _validate_mapping_data(mapping):
+        """
+        Функция _validate_mapping_data проверяет мэпинг атрибутов до начала загрузки.
+        Для каждой строки должны быть указаны id, name и известный type, для ссылочных атрибутов - folder и class.
+
+        :param mapping: Список словарей мэпинга
+        """
+        if not mapping:
+            raise ValueError(f'Mapping file {attributes_file} is empty')
+        for row_number, attribute in enumerate(mapping, start=2):
+            missing = [column for column in ('id', 'type', 'name', 'regexp', 'regexp_name') if column not in attribute]
+            if missing:
+                raise ValueError(f'Mapping file {attributes_file} has no columns {missing}')
+            if not attribute['id'] or not attribute['name']:
+                raise ValueError(f'Mapping file {attributes_file}, row {row_number}: id and name are required')
+            if attribute['type'] not in (1, 2, 3, 5, 6, 8):
+                raise ValueError(f'Mapping file {attributes_file}, row {row_number}: unknown type {attribute["type"]}')
+            if attribute['type'] == 8 and not (attribute.get('folder') and attribute.get('class')):
+                raise ValueError(f'Mapping file {attributes_file}, row {row_number}: folder and class are required')
+            if attribute['regexp'] and not attribute['regexp_name']:
+                raise ValueError(f'Mapping file {attributes_file}, row {row_number}: regexp_name is required')
+
+    @staticmethod
+    def get_mapped_attributes():
+        """
+        Функция get_mapped_attributes возвращает список пар (id атрибута, имя колонки) из мэпинга.
+        Для атрибутов с регулярным выражением используется имя regexp_name. Список строится один раз за процесс.
+
+        :return: Список кортежей
+        """
+        if LevelOne.MAPPED_ATTRIBUTES is None:
+            LevelOne.MAPPED_ATTRIBUTES = [
+                (attribute['id'], attribute['regexp_name'] if attribute['regexp'] else attribute['name'])
+                for attribute in LevelOne.load_mapping_data()
+            ]
+        return LevelOne.MAPPED_ATTRIBUTES
+
+    @staticmethod
+    def get_excel_columns():
+        """
+        Функция get_excel_columns возвращает имена колонок файла выгрузки, которые нужны для загрузки:
+        колонки мэпинга, ключевая колонка, колонка второго уровня и колонки режима из EXCEL_MODE_COLUMNS.
+
+        :return: frozenset имен колонок
+        """
+        if LevelOne.EXCEL_COLUMNS is None:
+            columns = {attribute['name'] for attribute in LevelOne.load_mapping_data()}
+            columns.update((key_column_name, level_two_column_name))
+            columns.update(LevelOne.EXCEL_MODE_COLUMNS.get(mode, ()))
+            LevelOne.EXCEL_COLUMNS = frozenset(columns)
+        return LevelOne.EXCEL_COLUMNS
+
+    @staticmethod
+    def get_schema():
+        """
+        Функция get_schema возвращает схему строк данных, общую для всех экземпляров LevelOne.
+
+        :return: Экземпляр RowSchema
+        """
+        if LevelOne.SCHEMA is None:
+            LevelOne.SCHEMA = RowSchema(LevelOne.load_mapping_data(), level_two_column_name, key_column_name)
+        return LevelOne.SCHEMA
 
     def __str__(self):
         return self.name
@@ -416,18 +1675,102 @@ class LevelOne(Neosintez):
         :param self: Экземпляр класса
         :return: Путь к файлу
         """
-        prefix = {
-            'appius': 'РД',
-            'mto': 'ЗО',
-            'delivery_order': 'Д',
-            'notification': 'У',
-        }
-
-        f_list = [f for f in os.listdir(path=files_directory) if self.name in f and prefix[mode] in f and '~' not in f]
+        prefix = self.FILE_PREFIX[mode]
+        f_list = self.get_files_group(self.name, prefix)
         if f_list:
-            f_date = [os.path.getctime(files_directory + f) for f in f_list]
-            self.f_path = files_directory + f_list[f_date.index(max(f_date))]
-            self.f_prev_path = files_directory + f'prev/{self.name}_{prefix[mode]}_prev.xlsx'
+            f_name = max(f_list, key=lambda x: x[1])[0]
+            self.f_path = files_directory + f_name
+            self.f_prev_path = files_directory + f'prev/{self.name}_{prefix}_prev.xlsx'
+
+    @staticmethod
+    def start_parsing(levels_one, workers):
+        """
+        Функция start_parsing находит файлы LevelOne levels_one и отправляет их разбор в пул процессов
+        в порядке обработки. get_new_items_data забирает строки файла, как только он разобран,
+        следующие файлы в это время разбираются в пуле. Если файл один, пул не создается.
+        Вперед разбирается не больше файлов, чем процессов в пуле (см. submit_parsing), чтобы строки разобранных,
+        но еще не обработанных файлов не накапливались в памяти.
+
+        :param levels_one: Список LevelOne
+        :param workers: Число процессов, 0 - по числу ядер
+        """
+        paths = {}
+        for level_one in levels_one:
+            level_one.get_file_path()
+            if level_one.f_path:
+                paths.setdefault(level_one.f_path, level_one.name)
+        if len(paths) < 2:
+            return
+        workers = min(workers or os.cpu_count() or 1, len(paths))
+        # кэш мэпинга обновляется до запуска пула, процессы пула читают его без разбора attributes_file
+        LevelOne.load_mapping_data()
+        logging.info(f'Parsing {len(paths)} files in {workers} processes')
+        LevelOne.EXECUTOR = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        LevelOne.PARSE_PATHS = list(paths.items())
+        LevelOne.PARSE_POSITIONS = {f_path: position for position, f_path in enumerate(paths)}
+        LevelOne.PARSE_NEXT = 0
+        LevelOne.PARSE_AHEAD = workers
+        LevelOne.submit_parsing(0)
+
+    @staticmethod
+    def submit_parsing(position):
+        """
+        Функция submit_parsing отправляет в пул разбор файлов PARSE_PATHS с позиций от position
+        до position + PARSE_AHEAD, которые еще не отправлены.
+
+        :param position: Позиция первого файла, который должен разбираться в пуле
+        """
+        # файлы до position уже пройдены в порядке обработки и не отправляются
+        LevelOne.PARSE_NEXT = max(LevelOne.PARSE_NEXT, position)
+        end = min(position + LevelOne.PARSE_AHEAD, len(LevelOne.PARSE_PATHS))
+        while LevelOne.PARSE_NEXT < end:
+            f_path, name = LevelOne.PARSE_PATHS[LevelOne.PARSE_NEXT]
+            LevelOne.PARSE_FUTURES[f_path] = LevelOne.EXECUTOR.submit(parse_level_one_file, name, f_path)
+            LevelOne.PARSE_NEXT += 1
+
+    @staticmethod
+    def stop_parsing():
+        """Функция stop_parsing отменяет неначатые задания разбора и закрывает пул процессов"""
+        if LevelOne.EXECUTOR is not None:
+            LevelOne.EXECUTOR.shutdown(cancel_futures=True)
+            LevelOne.EXECUTOR = None
+            LevelOne.PARSE_FUTURES.clear()
+            LevelOne.PARSE_PATHS = []
+            LevelOne.PARSE_POSITIONS = {}
+            LevelOne.PARSE_NEXT = 0
+
+    @staticmethod
+    def get_files_index():
+        """
+        Функция get_files_index возвращает индекс файлов каталога files_directory.
+        Каталог читается один раз за запуск через os.scandir, дата создания файла берется из результатов сканирования,
+        поэтому для каждого LevelOne не выполняются отдельные обращения к сетевому каталогу.
+
+        :return: Список кортежей (имя файла, дата создания)
+        """
+        if LevelOne.FILES_INDEX is None:
+            with os.scandir(files_directory) as entries:
+                LevelOne.FILES_INDEX = [(entry.name, entry.stat().st_ctime) for entry in entries
+                                        if entry.is_file() and '~' not in entry.name]
+            LevelOne.FILES_GROUPS = {}
+        return LevelOne.FILES_INDEX
+
+    @staticmethod
+    def get_files_group(name, prefix):
+        """
+        Функция get_files_group возвращает файлы из индекса каталога, в имени которых есть имя LevelOne и префикс режима.
+        Результат запоминается по паре (имя, префикс).
+
+        :param name: Имя объекта LevelOne
+        :param prefix: Префикс файлов режима
+        :return: Список кортежей (имя файла, дата создания)
+        """
+        files_index = LevelOne.get_files_index()
+        group = LevelOne.FILES_GROUPS.get((name, prefix))
+        if group is None:
+            group = [f for f in files_index if name in f[0] and prefix in f[0]]
+            LevelOne.FILES_GROUPS[(name, prefix)] = group
+        return group
 
     def _get_data_from_excel(self) -> list[dict]:
         """
@@ -437,7 +1780,10 @@ class LevelOne(Neosintez):
         :param self: Экземпляр класса
         :return: Список словарей
         """
-        data = self._read_excel(self.f_path).to_json(orient='records', force_ascii=False)
+        with Metrics.timer('stage_file'):
+            content, self.f_stat = self.stage_file(self.f_path)
+        with Metrics.timer('read_excel'):
+            data = self._read_excel(content).to_json(orient='records', force_ascii=False)
         input_data = json.loads(data) if data else list()
         # отбор только восстановленных в Марково
         if input_data and mode == 'mto' and self.name in 'МВЗ000821;МВЗ001069;МВЗ004863;МВЗ004864':
@@ -450,18 +1796,21 @@ class LevelOne(Neosintez):
     def _read_excel(file_path):
         """
         Функция _read_excel считывает файл excel и возвращает фрейм данных.
-        Функция принимает в качестве аргумента путь к excel-файлу.
+        Функция принимает в качестве аргумента путь к excel-файлу. Читаются только колонки из get_excel_columns,
+        колонки, которых нет в файле, пропускаются.
         Затем она проверяет, какой режим используется, и на основании этого считывает различные столбцы из 
         разных листов excel-файла. Кроме того, она преобразует некоторые столбцы в строки, чтобы ими можно было 
         было манипулировать в дальнейшем.
         
-        :param file_path: Указывает путь к считываемому файлу.
+        :param file_path: Путь к файлу или файловый объект с содержимым файла, см. stage_file.
         :return: Фрейм данных pandas
         """
+        columns = LevelOne.get_excel_columns()
         if mode == 'appius':
             data = pd.read_excel(
                 file_path,
                 sheet_name='TDSheet',
+                usecols=columns.__contains__,
                 converters={
                     '№ поз. по ГП': str,
                     'Изм.': str
@@ -475,6 +1824,7 @@ class LevelOne(Neosintez):
             data = pd.read_excel(
                 file_path,
                 sheet_name='TDSheet',
+                usecols=columns.__contains__,
                 converters={
                     'Код (НСИ)': str,
                     'Потребность.Номер': str,
@@ -485,6 +1835,7 @@ class LevelOne(Neosintez):
             data = pd.read_excel(
                 file_path,
                 sheet_name='TDSheet',
+                usecols=columns.__contains__,
                 converters={
                     'Документ заказа.Номер': str,
                     'Потребность.Номенклатура.Код': str,
@@ -497,6 +1848,7 @@ class LevelOne(Neosintez):
             data = pd.read_excel(
                 file_path,
                 sheet_name='TDSheet',
+                usecols=columns.__contains__,
                 converters={
                     'Потребность.Номенклатура.Код': str,
                     'Потребность.Номер': str,
@@ -525,20 +1877,91 @@ class LevelOne(Neosintez):
     #     else:
     #         self.update_data = self.new_data.copy()
     #
+    @staticmethod
+    def _get_file_stat(f_path):
+        """Функция _get_file_stat возвращает размер и время изменения файла в наносекундах"""
+        stat = os.stat(f_path)
+        return stat.st_size, stat.st_mtime_ns
+
+    @staticmethod
+    def stage_file(f_path):
+        """
+        Функция stage_file считывает файл выгрузки в память одним последовательным чтением вместо множества мелких
+        чтений openpyxl с сетевого диска. Размер и время изменения файла до и после чтения должны совпадать,
+        иначе 1С перезаписывает файл во время чтения, и чтение повторяется через staging_retry_delay секунд,
+        всего staging_attempts попыток.
+
+        :param f_path: Путь к файлу
+        :return: Кортеж (BytesIO с содержимым файла, (размер, время изменения))
+        """
+        for attempt in range(1, staging_attempts + 1):
+            f_stat = LevelOne._get_file_stat(f_path)
+            with open(f_path, 'rb') as f:
+                content = f.read()
+            if len(content) == f_stat[0] and LevelOne._get_file_stat(f_path) == f_stat:
+                return io.BytesIO(content), f_stat
+            logging.warning(f'File {f_path} is changed while reading, attempt {attempt}')
+            if attempt < staging_attempts:
+                time.sleep(staging_retry_delay)
+        raise OSError(f'File {f_path} is changed while reading in {staging_attempts} attempts')
+
     def delete_file(self):
+        """
+        Функция delete_file переносит обработанный файл в каталог prev в отдельном потоке, не задерживая
+        обработку следующих LevelOne. Результат переноса проверяется в wait_archiving.
+
+        :param self: Экземпляр класса
+        """
         # shutil.copy2(self.f_path, self.f_prev_path)
         # os.remove(self.f_path)
-        os.replace(self.f_path, self.f_prev_path)
+        if LevelOne.ARCHIVER is None:
+            LevelOne.ARCHIVER = ThreadPoolExecutor(max_workers=1)
+        LevelOne.ARCHIVE_FUTURES.append(
+            LevelOne.ARCHIVER.submit(self._archive_file, self.f_path, self.f_prev_path, self.f_stat))
+
+    @staticmethod
+    def _archive_file(f_path, f_prev_path, f_stat):
+        """
+        Функция _archive_file переносит файл f_path в f_prev_path. Файл, измененный после чтения (новая выгрузка 1С),
+        не переносится и загружается в следующий запуск.
+
+        :param f_stat: Размер и время изменения файла при чтении, None - не проверять
+        :return: True, если файл перенесен
+        """
+        if f_stat is not None and LevelOne._get_file_stat(f_path) != f_stat:
+            logging.warning(f'File {f_path} is changed after reading and is left for the next run')
+            return False
+        os.replace(f_path, f_prev_path)
+        return True
+
+    @staticmethod
+    def wait_archiving():
+        """
+        Функция wait_archiving дожидается переноса файлов в prev и закрывает поток переноса.
+
+        :return: Число перенесенных файлов
+        """
+        moved = 0
+        for future in LevelOne.ARCHIVE_FUTURES:
+            try:
+                moved += future.result()
+            except OSError:
+                logging.exception('File is not moved to prev folder')
+        LevelOne.ARCHIVE_FUTURES.clear()
+        if LevelOne.ARCHIVER is not None:
+            LevelOne.ARCHIVER.shutdown()
+            LevelOne.ARCHIVER = None
+        return moved
 
     def _get_data_from_neosintez(self):
         """
         Функция _get_data_from_neosintez используется для получения данных из API Neosintez.
         Она принимает единственный аргумент self, который является экземпляром класса Neosintez.
-        Функция возвращает JSON-объект, содержащий все элементы в Neosintez, соответствующие определенным критериям (например 
-        item_class_id и parent).
+        Функция возвращает генератор объектов Neosintez, соответствующих определенным критериям (например 
+        item_class_id и parent). Ответ разбирается потоково, см. Neosintez.iter_search_objects.
         
         :param self: Экземпляр класса
-        :return: Список словарей
+        :return: Генератор словарей
         :doc-author: Trelent
         """
         req_url = url + 'api/objects/search?take=50000'
@@ -563,36 +1986,81 @@ class LevelOne(Neosintez):
                     "Operator": 1
                 }
             ]
-        payload = json.dumps(payload)
+        atr_ids = [atr_id for atr_id, _ in self.get_mapped_attributes()]
+        return self._search_items(req_url, payload, atr_ids)
+
+    @staticmethod
+    def _search_items(req_url, payload, atr_ids, page=None):
+        """
+        Функция _search_items выполняет поисковый запрос, по возможности только с атрибутами atr_ids.
+
+        :param req_url: Адрес поискового запроса
+        :param payload: Тело поискового запроса
+        :param atr_ids: id нужных атрибутов
+        :param page: Словарь для Total ответа, см. Neosintez.iter_search_objects
+        :return: Генератор словарей
+        """
         headers = {
             'Accept': 'application/json',
             'Authorization': f'Bearer {Neosintez.TOKEN}',
             'Content-Type': 'application/json-patch+json',
             'X-HTTP-Method-Override': 'GET'
         }
-        # поисковый запрос
-        response = Neosintez.SESSION.post(req_url, headers=headers, data=payload)
-        response = json.loads(response.text)
-        return response
+        # поисковый запрос, по возможности только с атрибутами из мэпинга
+        if search_projection and LevelOne.PROJECTION_SUPPORTED is not False:
+            response = Neosintez.request('POST', req_url, headers=headers, stream=True,
+                                         data=json.dumps(dict(payload, Attributes=atr_ids)))
+            if response.status_code == 400:
+                response.close()
+                logging.warning('Search attribute projection is rejected by server, full objects are requested')
+                LevelOne.PROJECTION_SUPPORTED = False
+            else:
+                objects = Neosintez.iter_search_objects(response, page=page)
+                if LevelOne.PROJECTION_SUPPORTED is None:
+                    objects = LevelOne._check_projection(objects, atr_ids)
+                return objects
+        response = Neosintez.request('POST', req_url, headers=headers, stream=True, data=json.dumps(payload))
+        return Neosintez.iter_search_objects(response, page=page)
 
-    def get_current_items_data(self):
+    @staticmethod
+    def _check_projection(objects, atr_ids):
         """
-        Функция get_current_items_data используется для получения текущих данных из Neosintez.
-        Она возвращает список словарей, где каждый словарь представляет элемент в Neosintez.
-        
-        :param self: Экземпляр класса
-        :return: Список словарей
+        Функция _check_projection по первому непустому ответу определяет, учел ли сервер отбор атрибутов.
+        Если в ответе есть атрибуты вне мэпинга, отбор не поддерживается и больше не отправляется.
+
+        :param objects: Генератор объектов поискового запроса
+        :param atr_ids: Запрошенные id атрибутов
+        :return: Генератор тех же объектов
         """
-        response = self._get_data_from_neosintez()
-        data = list()
-        for item in response['Result']:
-            item_dict = {'id': item['Object']['Id']}
-            for attribute in self.mapping_data:
-                atr_id = attribute['id']
-                name = attribute['name']
-                if attribute['regexp']:
-                    name = attribute['regexp_name']
-                result = item['Object']['Attributes'].get(atr_id)
+        atr_ids = set(atr_ids)
+        checked = False
+        for item in objects:
+            if LevelOne.PROJECTION_SUPPORTED is None and any(atr_id not in atr_ids for atr_id in item['Attributes']):
+                LevelOne.PROJECTION_SUPPORTED = False
+                logging.info('Search attribute projection is ignored by server, full objects are requested')
+            checked = True
+            yield item
+        if checked and LevelOne.PROJECTION_SUPPORTED is None:
+            LevelOne.PROJECTION_SUPPORTED = True
+
+    @staticmethod
+    def _get_current_rows(objects, partition_attribute_id=None):
+        """
+        Функция _get_current_rows преобразует объекты Neosintez в строки current_data, см. RowSchema.current_columns.
+
+        :param objects: Объекты поискового запроса
+        :param partition_attribute_id: id атрибута, значение которого выдается вместе со строкой
+        :return: Генератор кортежей или, если передан partition_attribute_id, пар (значение атрибута, кортеж)
+        """
+        schema = LevelOne.get_schema()
+        attributes_positions = list(zip((atr_id for atr_id, _ in LevelOne.get_mapped_attributes()),
+                                        schema.current_positions))
+        for item in objects:
+            row = [None] * len(schema.current_columns)
+            row[0] = item['Id']
+            attributes = item['Attributes']
+            for atr_id, position in attributes_positions:
+                result = attributes.get(atr_id)
                 if result:
                     atr_value = result['Value']
                     if result['Type'] == 8:
@@ -604,23 +2072,150 @@ class LevelOne(Neosintez):
                 else:
                     atr_value = None
 
-                item_dict[name] = atr_value
+                row[position] = atr_value
+
+            if partition_attribute_id is None:
+                yield tuple(row)
+            else:
+                partition = attributes.get(partition_attribute_id)
+                yield partition['Value'] if partition else None, tuple(row)
+
+    @staticmethod
+    def get_root_partitions(root_id):
+        """
+        Функция get_root_partitions используется в режиме mto вместо отдельного поиска для каждого LevelOne.
+        Объекты класса item_class_id корня root_id получаются одним постраничным поиском по search_page_size объектов,
+        пока не получены все Total объектов, и раскладываются по значению атрибута level_one_name_attribute_id в строки current_data.
+        Значение атрибута сравнивается с именами LevelOne без учета регистра и пробелов по краям (см. get_partition_name),
+        объекты, не относящиеся ни к одному LevelOne корня, выводятся в лог.
+        Результат сохраняется для последнего обработанного корня.
+
+        :param root_id: id корня
+        :return: Словарь {имя LevelOne: список кортежей}
+        """
+        if root_id in LevelOne.ROOT_PARTITIONS:
+            return LevelOne.ROOT_PARTITIONS[root_id]
+
+        payload = {
+            "Filters": [
+                {
+                    "Type": 4,
+                    "Value": root_id
+                },
+                {
+                    "Type": 5,
+                    "Value": item_class_id
+                }
+            ]
+        }
+        atr_ids = [atr_id for atr_id, _ in LevelOne.get_mapped_attributes()]
+        if level_one_name_attribute_id not in atr_ids:
+            atr_ids.append(level_one_name_attribute_id)
+        partitions = {}
+        skip = 0
+        while True:
+            page = {}
+            objects = LevelOne._search_items(url + f'api/objects/search?take={search_page_size}&skip={skip}',
+                                             payload, atr_ids, page)
+            count = 0
+            for level_one_name, row in LevelOne._get_current_rows(objects, level_one_name_attribute_id):
+                partitions.setdefault(LevelOne.get_partition_name(level_one_name), []).append(row)
+                count += 1
+            skip += count
+            # сервер может вернуть страницу меньше search_page_size, поэтому конец определяется по Total
+            if not count or skip >= page['Total']:
+                break
+        logging.info(f'Total entities in root {root_id} {skip}')
+        names = set(LevelOne.get_partition_name(name)
+                    for root in Neosintez.ROOTS if root.root_id == root_id for name in root.keys_list)
+        unknown = {name: len(rows) for name, rows in partitions.items() if name not in names}
+        if unknown:
+            logging.warning(f'Entities in root {root_id} with level one name out of root config {unknown}')
+        LevelOne.ROOT_PARTITIONS = {root_id: partitions}
+        return partitions
+
+    @staticmethod
+    def get_partition_name(name):
+        """Функция get_partition_name приводит имя LevelOne к виду для сравнения: без пробелов по краям, без учета регистра"""
+        return None if name is None else str(name).strip().casefold()
+
+    @staticmethod
+    def set_root_wide(levels_one):
+        """
+        Функция set_root_wide в режиме mto с root_wide_fetch включает общий поиск по корню (get_root_partitions)
+        для LevelOne корней, у которых файлы есть хотя бы у двух LevelOne из levels_one. Если файл у корня один,
+        общий поиск загрузил бы объекты всех LevelOne корня, поэтому объекты ищутся только для этого LevelOne.
+
+        :param levels_one: Список LevelOne загрузки
+        """
+        if mode != 'mto' or not root_wide_fetch:
+            return
+        files_count = {}
+        for level_one in levels_one:
+            level_one.get_file_path()
+            if level_one.f_path:
+                files_count[level_one.parent] = files_count.get(level_one.parent, 0) + 1
+        for level_one in levels_one:
+            level_one.root_wide = files_count.get(level_one.parent, 0) >= 2
+
+    def forget_moved_item(self, item_id):
+        """
+        Функция forget_moved_item убирает объект, найденный по ключу у другого LevelOne и перенесенный в этот LevelOne,
+        из строк других LevelOne в get_root_partitions, чтобы они не считали его своим.
 
-            data.append(item_dict)
-        self.current_data = data
+        :param item_id: id объекта
+        """
+        partition_name = self.get_partition_name(self.name)
+        for level_one_name, rows in LevelOne.ROOT_PARTITIONS.get(self.parent, {}).items():
+            if level_one_name != partition_name:
+                rows[:] = [row for row in rows if row[0] != item_id]
+
+    def get_current_items_data(self):
+        """
+        Функция get_current_items_data используется для получения текущих данных из Neosintez.
+        Она сохраняет в current_data список кортежей, где каждый кортеж представляет элемент в Neosintez,
+        колонки кортежа - RowSchema.current_columns.
+        Для LevelOne с root_wide данные берутся из общего поиска по корню, см. get_root_partitions и set_root_wide.
+        
+        :param self: Экземпляр класса
+        """
+        with Metrics.timer('get_data_from_neosintez'):
+            if self.root_wide:
+                self.current_data = self.get_root_partitions(self.parent).get(self.get_partition_name(self.name), [])
+            else:
+                self.current_data = list(self._get_current_rows(self._get_data_from_neosintez()))
 
     def get_new_items_data(self):
         """
-        Функция get_new_items_data получает данные из файла Excel и преобразует их в список словарей.
-        Каждый словарь представляет собой один элемент в файле Excel, ключи которого соответствуют именам столбцов, а значения - содержимому ячеек.
+        Функция get_new_items_data сохраняет в new_data строки файла LevelOne с объединенными дублями ключей.
+        Если файл отправлен в пул разбора (start_parsing), строки ожидаются из пула, иначе файл разбирается здесь.
+        Пока строки ожидаются, в пул отправляются следующие файлы.
+
+        :param self: Экземпляр класса
+        """
+        future = LevelOne.PARSE_FUTURES.pop(self.f_path, None)
+        position = LevelOne.PARSE_POSITIONS.get(self.f_path)
+        if position is not None:
+            LevelOne.submit_parsing(position + 1)
+        if future is not None:
+            data, seconds, self.f_stat = future.result()
+            Metrics.add_time('read_excel', seconds)
+        else:
+            data = self.read_new_items_data()
+        self.new_data = self.coalesce_new_data(data)
+
+    def read_new_items_data(self):
+        """
+        Функция read_new_items_data получает данные из файла Excel и преобразует их в список кортежей.
+        Каждый кортеж представляет собой один элемент в файле Excel, колонки кортежа - RowSchema.columns.
         Если тип атрибута равен 8 и значение атрибута является строкой, то происходит замена точки на пустую строку в значении атрибута.
         Далее, если в атрибуте указано регулярное выражение, то происходит поиск по регулярному выражению и извлечение нужной части значения атрибута.
         Изменяются также имя атрибута на значение из атрибута regexp_name. Затем, если значение атрибута не пустое,
         вызывается соответствующий метод из словаря func_dict, в который передаются значения value и atr.
-        Результат сохраняется как значение в словаре item_dict по ключу name. Таким образом, для каждого атрибута из self.mapping_data формируется словарь item_dict. 
+        Результат сохраняется в колонку name строки. Таким образом, для каждой строки excel-файла формируется кортеж значений атрибутов из self.mapping_data. 
         
         :param self:  Экземпляр класса
-        :return: Список словарей, где каждый словарь - это строка из excel-файла
+        :return: Список кортежей
         """
         func_dict = {
             1: self.float_atr,
@@ -629,51 +2224,174 @@ class LevelOne(Neosintez):
             5: self.date_atr,
             8: self.str_atr,
         }
+        schema = self.get_schema()
+        attributes_positions = list(zip(self.mapping_data, schema.new_positions))
         input_data = self._get_data_from_excel()
         data = list()
         for item in input_data:
-            item_dict = {}
-            for attribute in self.mapping_data:
-                name = attribute['name']
+            row = [None] * len(schema.columns)
+            for attribute, position in attributes_positions:
                 atr_type = attribute['type']
-                atr_value = item.get(name)
+                atr_value = item.get(attribute['name'])
                 if atr_type == 8 and isinstance(atr_value, str):
                     atr_value = atr_value.replace('.', '')
                 if attribute['regexp']:
                     atr_value = self.get_by_re(atr_value, attribute['regexp'])
-                    name = attribute['regexp_name']
                 if atr_value:
                     atr_value = func_dict.get(atr_type, self.str_atr)(value=atr_value, atr=attribute)
-                item_dict[name] = atr_value
+                row[position] = atr_value
             level_two_name = item.get(level_two_column_name, "Прочее")
-            item_dict[level_two_column_name] = level_two_name if level_two_name else "Прочее"
-            data.append(item_dict)
-        self.new_data = data
+            row[schema.level_two_position] = level_two_name if level_two_name else "Прочее"
+            data.append(tuple(row))
+        return data
+
+    def coalesce_new_data(self, data):
+        """
+        Функция coalesce_new_data объединяет строки new_data с одинаковым каноническим ключом в одну по duplicate_keys_policy:
+        last - последняя строка, first - первая строка, sum - последняя строка с суммой числовых (тип 1) колонок всех строк
+        (только колонок duplicate_keys_sum_columns, если они указаны).
+        Ключи, строки которых различаются, сохраняются в conflicts и попадают в лог и план.
+
+        :param data: Список кортежей new_data
+        :return: Список кортежей с одной строкой на ключ в порядке первого появления ключа
+        """
+        schema = self.get_schema()
+        groups = dict()
+        for row in data:
+            groups.setdefault(schema.new_key(row), []).append(row)
+        if len(groups) == len(data):
+            self.conflicts = []
+            return data
+
+        numeric_positions = [position for position, (name, atr_type) in enumerate(zip(schema.mapping_columns,
+                                                                                    schema.mapping_types))
+                             if atr_type == 1 and position != schema.key_position
+                             and (not duplicate_keys_sum_columns or name in duplicate_keys_sum_columns)]
+        coalesced = list()
+        conflicts = list()
+        for rows in groups.values():
+            if len(rows) == 1:
+                coalesced.append(rows[0])
+                continue
+            if any(not schema.same_new(rows[0], row) for row in rows[1:]):
+                conflicts.append(rows[0][schema.key_position])
+            if duplicate_keys_policy == 'first':
+                coalesced.append(rows[0])
+            elif duplicate_keys_policy == 'sum':
+                row = list(rows[-1])
+                for position in numeric_positions:
+                    values = [item[position] for item in rows if isinstance(item[position], (int, float))
+                              and item[position] == item[position]]
+                    if values:
+                        row[position] = math.fsum(values)
+                coalesced.append(tuple(row))
+            else:
+                coalesced.append(rows[-1])
+        duplicates_count = len(data) - len(coalesced)
+        logging.info(f'Duplicate keys in file {len(groups) - sum(len(rows) == 1 for rows in groups.values())}, '
+                     f'rows merged {duplicates_count} ({duplicate_keys_policy})')
+        if conflicts:
+            logging.warning(f'Duplicate keys with different values {len(conflicts)}: {conflicts[:10]}')
+        Metrics.count('duplicate_rows', duplicates_count)
+        Metrics.count('duplicate_key_conflicts', len(conflicts))
+        self.conflicts = conflicts
+        return coalesced
+
+    def resolve_doubles(self):
+        """
+        Функция resolve_doubles сопоставляет строки current_data каноническим ключам.
+        Из нескольких объектов с ключом, который есть в new_data, остается один из объектов, находящихся в папке
+        второго уровня строки new_data (см. get_level_two_items): совпадающий со строкой new_data,
+        иначе - с наибольшим числом заполненных атрибутов, при равенстве - первый. Остальные объекты попадают
+        в double_items_id для удаления, а id оставшегося передается в push_into_neosintez без поиска по ключу.
+        Если в нужной папке нет ни одного из объектов, удаляются все, и объект создается в нужной папке заново.
+        Так же проверяется единственный объект ключа, строка которого будет обновлена: обновление идет по его id,
+        поиск по исходному значению ключа не найдет объект, если ключ отличается только представлением.
+
+        :param self: Экземпляр класса
+        :return: Словарь {канонический ключ: строка current_data}
+        """
+        schema = self.get_schema()
+        canonical = schema.canonical
+        groups = dict()
+        for row in self.current_data:
+            groups.setdefault(schema.current_key(row), []).append(row)
+        new_rows = {schema.new_key(row): row for row in self.new_data}
+
+        def rank(row, new_row):
+            equal = new_row is not None and (schema.same(new_row, row) or schema.same_canonical(new_row, row))
+            filled = sum(canonical(value, atr_type) is not None
+                         for value, atr_type in zip(row[1:], schema.mapping_types))
+            return equal, filled
+
+        double_keys = set(key for key, rows in groups.items() if len(rows) > 1 and key in new_rows)
+        changed_keys = set(key for key, rows in groups.items()
+                           if len(rows) == 1 and key in new_rows and not rank(rows[0], new_rows[key])[0])
+        check_keys = double_keys | changed_keys
+        level_two_position = schema.level_two_position
+        level_two_items, unknown_levels_two = self.get_level_two_items(
+            set(new_rows[key][level_two_position] for key in check_keys))
+
+        current_by_key = dict()
+        survivors = dict()
+        double_items_id = set()
+        for key, rows in groups.items():
+            if key not in check_keys:
+                current_by_key[key] = rows[-1]
+                continue
+            new_row = new_rows[key]
+            level_two = new_row[level_two_position]
+            if level_two not in unknown_levels_two:
+                rows_in_level_two = [row for row in rows if level_two_items.get(row[0]) == level_two]
+            else:
+                rows_in_level_two = rows
+            survivor = max(rows_in_level_two, key=lambda row: rank(row, new_row)) if rows_in_level_two else None
+            if survivor is not None:
+                current_by_key[key] = survivor
+                survivors[key] = survivor[0]
+            double_items_id.update(row[0] for row in rows if row is not survivor)
+        if double_keys:
+            logging.info(f'Duplicate keys resolved {len(double_keys)}, extra objects '
+                         f'{sum(len(groups[key]) for key in double_keys) - len(survivors.keys() & double_keys)}')
+        if check_keys - survivors.keys():
+            logging.info(f'Keys without object in level two {len(check_keys - survivors.keys())}, '
+                         f'objects are recreated')
+        Metrics.count('duplicates_resolved', len(double_keys))
+        self.current_by_key = current_by_key
+        self.survivors = survivors
+        self.double_items_id = double_items_id
+        return current_by_key
 
     def get_update_data(self):
         """
-        Функция get_update_data сравнивает списки словарей current_data и new_data.
-        Если словарь в new_data имеет тот же ключ, что и словарь в текущих данных, то производится сравнение на предмет наличия различий.
-        Если различий нет, то этот элемент не добавляется в список словарей update_data. Если различия есть, 
-        то этот элемент добавляется в список словарей update_data.
+        Функция get_update_data сравнивает строки current_data и new_data.
+        Если строка в new_data имеет тот же ключ, что и строка в текущих данных, то производится сравнение на предмет наличия различий
+        (RowSchema.same, при различиях - RowSchema.same_canonical). Если различий нет, то этот элемент не добавляется в список update_data.
+        Если различия есть, то этот элемент добавляется в список update_data.
         
         :param self: Экземпляр класса
-        :return: Список словарей
         """
+        schema = self.get_schema()
         for_update = list()
-        current_dict = dict(map(lambda x: (x[key_column_name], x), self.current_data))
+        spurious_count = 0
+        changed_count = 0
+        current_dict = self.resolve_doubles()
         for new_item in self.new_data:
-            match_item = current_dict.get(new_item[key_column_name])
+            match_item = current_dict.get(schema.new_key(new_item))
             if match_item:
-                match_item_for_compare = match_item.copy()
-                del match_item_for_compare['id']
-                new_item_for_compare = new_item.copy()
-                if 'Папка' in new_item_for_compare:
-                    del new_item_for_compare['Папка']
-                if new_item_for_compare == match_item_for_compare:
+                if schema.same(new_item, match_item):
+                    continue
+                # различия только в представлении значений (1.0 и '1', точки в ссылках, '' и None) не обновляются
+                if schema.same_canonical(new_item, match_item):
+                    spurious_count += 1
                     continue
+                changed_count += 1
             for_update.append(new_item)
         self.update_data = for_update
+        if spurious_count:
+            logging.info(f'Updates skipped as equal after normalization {spurious_count}')
+        Metrics.count('spurious_updates', spurious_count)
+        Metrics.count('objects_changed', changed_count)
 
     # def __get_keys_from_neosintez(self):
     #     response = self._get_data_from_neosintez()
@@ -687,6 +2405,12 @@ class LevelOne(Neosintez):
 
     @property
     def total_in_neosintez(self):      
+        """
+        Функция total_in_neosintez возвращает число объектов LevelOne в Neosintez после загрузки.
+        Для LevelOne с root_wide число рассчитывается по current_data, удаленным и добавленным объектам без запроса.
+        """
+        if self.root_wide:
+            return len(self.current_data) - self.deleted_count + self.added_count
         req_url = url + 'api/objects/search?take=0'
         payload = {
             "Filters": [
@@ -717,37 +2441,22 @@ class LevelOne(Neosintez):
             'X-HTTP-Method-Override': 'GET'
         }
         # поисковый запрос
-        response = Neosintez.SESSION.post(req_url, headers=headers, data=payload)
+        response = Neosintez.request('POST', req_url, headers=headers, data=payload)
         response = json.loads(response.text)
         return response['Total']
 
     def get_delete_items(self):
         """
         Функция get_delete_items используется для поиска элементов, которые должны быть удалены из current_data.
-        Сначала функция создает словарь всех элементов в current_data, в котором в качестве ключа указывается их id, а в качестве значения - их value.
-        Затем она находит все дублирующиеся значения в этом словаре, создавая кортеж, содержащий идентификатор каждого элемента и его количество в 
-        списке значений (list(items.values())). Затем отфильтровываются кортежи, в которых менее 2 дубликатов, и остаются только те,
-        в которых более одного дубликата. Полученный набор содержит все идентификаторы, для которых есть дубликаты, основанные на имени_ключевого_столбца
+        Удаляются объекты, ключей которых нет в new_data, и лишние объекты-дубли по ключевому атрибуту,
+        один объект из дублей остается, см. resolve_doubles. Вызывается после get_update_data.
 
         :param self: Экземпляр класса
-        :return: Набор идентификаторов, которые должны быть удалены
         """
-
-        items = dict(map(lambda x: (x['id'], x[key_column_name]), self.current_data))
-        # кортеж идентификаторов дублей по ключевому атрибуту
-        double_items = tuple(
-            filter(lambda k: k[1] > 1, map(lambda x: (x[0], list(items.values()).count(x[1])), items.items())))
-        double_items_id = set(item[0] for item in double_items)
-
-        item_key_set = set(items.values())
-        import_item_key_set = set(map(lambda x: x[key_column_name], self.new_data))
-
-        canceled_items_set = item_key_set - import_item_key_set
-        canceled_items = tuple(filter(lambda x: x[1] in canceled_items_set, items.items()))
-
-        canceled_items_id = set(item[0] for item in canceled_items)
-
-        self.delete_items_id = canceled_items_id | double_items_id
+        schema = self.get_schema()
+        import_item_key_set = set(map(schema.new_key, self.new_data))
+        canceled_items_id = set(row[0] for row in self.current_data if schema.current_key(row) not in import_item_key_set)
+        self.delete_items_id = canceled_items_id | self.double_items_id
 
     def delete_items(self):
         """
@@ -765,11 +2474,105 @@ class LevelOne(Neosintez):
                     'Authorization': f'Bearer {Neosintez.TOKEN}',
                     'Content-Type': 'application/json-patch+json'
                 }
-                response = Neosintez.SESSION.delete(req_url, headers=headers)
+                response = Neosintez.request('DELETE', req_url, headers=headers)
                 if response.status_code == 200:
                     counter += 1
+        self.deleted_count = counter
         return counter
 
+    def get_plan(self):
+        """
+        Функция get_plan формирует план изменений LevelOne без записи в Neosintez (режим --plan).
+        План содержит ключи создаваемых объектов, обновляемые объекты с изменениями по атрибутам
+        в виде {атрибут: [текущее значение, новое значение]} (значения, равные после RowSchema.canonical, не входят), удаляемые объекты, ключи повторяющихся в файле строк
+        с разными значениями и оценку числа запросов к API.
+        Вызывается после get_update_data и get_delete_items.
+
+        :param self: Экземпляр класса
+        :return: Словарь плана
+        """
+        schema = self.get_schema()
+        key_position = schema.key_position
+        # колонки мэпинга сравниваются по каноническим значениям, как в get_update_data, остальные колонки - как есть
+        column_types = dict(zip(schema.mapping_columns, schema.mapping_types))
+        create = list()
+        update = list()
+        for new_item in self.update_data:
+            match_item = self.current_by_key.get(schema.new_key(new_item))
+            if not match_item:
+                create.append(new_item[key_position])
+                continue
+            changes = dict()
+            for name in schema.columns:
+                if name == 'Папка':
+                    continue
+                new_value = schema.get(new_item, name)
+                current_value = schema.get_current(match_item, name)
+                atr_type = column_types.get(name)
+                if atr_type is None:
+                    changed = new_value != current_value
+                else:
+                    changed = schema.canonical(new_value, atr_type) != schema.canonical(current_value, atr_type)
+                if changed:
+                    changes[name] = [current_value, new_value]
+            update.append({'key': new_item[key_position], 'id': match_item[0], 'changes': changes})
+
+        items = dict(map(lambda x: (x[0], x[schema.current_key_position]), self.current_data))
+        survivors_id = set(self.survivors.values())
+        delete = [{'id': item_id, 'key': items.get(item_id)} for item_id in sorted(self.delete_items_id)]
+        return {
+            'root': self.parent,
+            'level_one': self.name,
+            'file': self.f_path,
+            'create': create,
+            'update': update,
+            'delete': delete,
+            'conflicts': self.conflicts,
+            'requests': self._estimate_requests(len(create), len(update), len(delete),
+                                                sum(1 for item in update if item['id'] in survivors_id)),
+        }
+
+    def _estimate_requests(self, create_count, update_count, delete_count, survivors_count=0):
+        """
+        Функция _estimate_requests оценивает число запросов к API для загрузки update_data:
+        удаление - один запрос на объект, поиск или создание папок второго уровня, поиск различных значений ссылочных
+        атрибутов, которых нет в Neosintez.REFERENCES,
+        поиск по ключу (кроме оставленных дублей с известным id) и запись атрибутов для обновляемых объектов,
+        создание с атрибутами для новых (в режиме mto с поиском по ключу, без поддержки создания с атрибутами -
+        с двумя записями атрибутов), поиск числа объектов после загрузки, если оно не рассчитывается без запроса
+        (см. total_in_neosintez).
+
+        :return: Словарь {тип запроса: число запросов}
+        """
+        schema = self.get_schema()
+        level_two_names = set(map(lambda x: x[schema.level_two_position], self.update_data))
+        ref_attributes = [attribute for attribute in self.mapping_data if attribute['type'] == 8]
+        ref_values = set((attribute['folder'], attribute['class'], str(schema.get(item, attribute['name'])).replace('.', ''))
+                         for item in self.update_data for attribute in ref_attributes
+                         if schema.get(item, attribute['name']))
+        ref_count = len(ref_values - Neosintez.REFERENCES.keys())
+        two_requests_create = not create_with_attributes or Neosintez.CREATE_WITH_ATTRIBUTES is False
+        total_count = 0 if self.root_wide else 1
+        return {
+            'search': len(level_two_names) + ref_count + (create_count if mode == 'mto' else 0) + update_count
+            - survivors_count + total_count,
+            'create': create_count,
+            'put': (create_count if two_requests_create else 0) + update_count,
+            'delete': delete_count,
+        }
+
+    @staticmethod
+    def save_plans():
+        """
+        Функция save_plans сохраняет планы изменений всех LevelOne запуска в сжатый json файл в каталоге logs_path.
+
+        :return: Имя файла
+        """
+        file_name = get_run_file_name('plan.json.gz')
+        with gzip.open(file_name, 'wt', encoding='utf-8') as f:
+            f.write(json.dumps(LevelOne.PLANS, ensure_ascii=False, default=str))
+        return file_name
+
     @staticmethod
     def _get_level_two_name_for_notification(s):
         """
@@ -794,122 +2597,487 @@ class LevelOne(Neosintez):
         :param self: Экземпляр класса
         :return: Набор имен второго уровня
         """
-        level_two_names = set(map(lambda x: x[level_two_column_name], self.update_data))
+        level_two_position = self.get_schema().level_two_position
+        level_two_names = set(map(lambda x: x[level_two_position], self.update_data))
         for level_two in level_two_names:
+            # папка уже найдена в get_level_two_items
+            if self.levels_two.get(level_two):
+                continue
             # id = LevelOne.get_id_by_name(self.id, level_two_class_id, level_two)
             item_id = self.get_id_by_name(self.parent, level_two_class_id, level_two, create=True)
             self.levels_two[level_two] = item_id
 
+    def get_level_two_items(self, level_two_names):
+        """
+        Функция get_level_two_items находит существующие папки второго уровня level_two_names без создания
+        и получает постраничным поиском id объектов класса item_class_id в них. Найденные папки сохраняются в levels_two.
+
+        :param level_two_names: Имена папок второго уровня
+        :return: Словарь {id объекта: имя папки второго уровня} и множество имен, для которых найдено несколько папок
+        """
+        level_two_items = dict()
+        unknown_levels_two = set()
+        for level_two in level_two_names:
+            folder_id = self.get_id_by_name(self.parent, level_two_class_id, level_two)
+            if folder_id is None:
+                unknown_levels_two.add(level_two)
+                continue
+            if not folder_id:
+                continue
+            self.levels_two[level_two] = folder_id
+            payload = {
+                "Filters": [
+                    {
+                        "Type": 4,
+                        "Value": folder_id
+                    },
+                    {
+                        "Type": 5,
+                        "Value": item_class_id
+                    }
+                ]
+            }
+            skip = 0
+            while True:
+                page = {}
+                objects = self._search_items(url + f'api/objects/search?take={search_page_size}&skip={skip}',
+                                             payload, [key_attribute_id], page)
+                count = 0
+                for item in objects:
+                    level_two_items[item['Id']] = level_two
+                    count += 1
+                skip += count
+                if not count or skip >= page['Total']:
+                    break
+        return level_two_items, unknown_levels_two
+
+    def get_request_body_prefix(self):
+        """
+        Функция get_request_body_prefix возвращает начало тела запроса записи атрибутов, общее для всех объектов LevelOne:
+        ссылку на объект и, в режиме mto, имя LevelOne.
+
+        :param self: Экземпляр класса
+        :return: Список словарей атрибутов
+        """
+        request_body_prefix = [
+            {
+                'Name': 'forvalidation',
+                'Value': self.object_request_body,
+                'Type': 8,
+                'Id': object_attribute_id
+            }
+        ]
+        if mode == 'mto':
+            request_body_prefix.append(
+                {
+                    'Name': 'forvalidation',
+                    'Value': self.name,
+                    'Type': 2,
+                    'Id': level_one_name_attribute_id
+                },
+            )
+        return request_body_prefix
+
     def push_into_neosintez(self):
         """
         Функция push_into_neosintez заносит данные в Neosintez.
         
         :param self: Экземпляр класса
         """
+        schema = self.get_schema()
+        request_body_prefix = self.get_request_body_prefix()
+        # объекты класса item_class_id под корнем уже получены в current_data, новые ключи можно не искать;
+        # в режиме mto current_data содержит только объекты этого LevelOne
+        current_keys = set(map(schema.current_key, self.current_data)) if mode != 'mto' else None
+        # объекты, найденные или созданные в этом запуске, по (папка второго уровня, ключ), для повторов ключа в файле
+        pushed = {}
+        own_ids = set(row[0] for row in self.current_data) if self.root_wide else None
+        # объекты ключей, сопоставленные в resolve_doubles в нужной папке второго уровня, обновляются по id без поиска,
+        # один раз на ключ
+        survivors = dict(self.survivors)
         for item_data in self.update_data:
+            key_value = item_data[schema.key_position]
+            parent_id = self.levels_two[item_data[schema.level_two_position]]
             item = Item(
-                key_value=item_data[key_column_name],
-                parent_id=self.levels_two[item_data[level_two_column_name]],
+                key_value=key_value,
+                parent_id=parent_id,
                 attributes_value=item_data,
-                object_request_body=self.object_request_body,
-                level_one_name=self.name,
-                mapping_data=self.mapping_data
+                request_body_prefix=request_body_prefix,
+                schema=schema,
+                search=current_keys is None or schema.new_key(item_data) in current_keys
             )
-            item.push_into_neosintez()
+            item.neosintez_id = pushed.get((parent_id, key_value))
+            pushed_before = item.neosintez_id is not None
+            if not pushed_before:
+                item.neosintez_id = survivors.pop(schema.new_key(item_data), None)
+            try:
+                item.push_into_neosintez()
+            except NeosintezUnavailableError:
+                raise
+            except requests.RequestException as e:
+                # ошибка после всех повторов запроса: объект пропускается, остальные объекты загружаются
+                logging.warning(f'Item {key_value} is not written: {e}')
+                Metrics.count('objects_failed')
+                continue
+            if not pushed_before and item.neosintez_id:
+                if item.created:
+                    self.added_count += 1
+                elif own_ids is not None and item.neosintez_id not in own_ids:
+                    self.added_count += 1
+                    self.forget_moved_item(item.neosintez_id)
+            if item.neosintez_id:
+                pushed[(parent_id, key_value)] = item.neosintez_id
 
 
 class Item(Neosintez):
+    __slots__ = ('key', 'parent_id', 'attributes_value', 'request_body_prefix', 'schema', 'name', 'neosintez_id',
+                 'request_body', 'search', 'created')
     # дата фрейм для мэпинга атрибутов и колонок эксель файла
     ATTRIBUTES_MAPPING = None
+    # шаблон атрибутов тела запроса, общий для всех экземпляров Item, см. get_template
+    TEMPLATE = None
 
-    def __init__(self, key_value, parent_id, attributes_value, object_request_body, level_one_name, mapping_data):
+    def __init__(self, key_value, parent_id, attributes_value, request_body_prefix, schema, search=True):
         """
         Инициализация класса.      
         
         :param self: Экземпляр класса.
         :param key_value: Хранит ключ объекта в словаре
         :param parent_id: Создает связь между родительским и дочерним объектами
-        :param attributes_value: Хранить данные из файла excel
-        :param object_request_body: Создать тело запроса для объекта
-        :param level_one_name: Создать новый атрибут в теле запроса
-        :param mapping_data: Хранить данные отображения
+        :param attributes_value: Строка данных из файла excel
+        :param request_body_prefix: Общее для объектов LevelOne начало тела запроса, см. LevelOne.get_request_body_prefix
+        :param schema: Схема строки attributes_value, см. RowSchema
+        :param search: Искать объект по ключу; False - объекта с таким ключом в Neosintez заведомо нет
         """
         
         self.key = key_value
         self.parent_id = parent_id
-        self.level_one_name = level_one_name
         self.attributes_value = attributes_value
-        self.object_request_body = object_request_body
-        self.mapping_data = mapping_data
-        self.request_body = [
-            {
-                'Name': 'forvalidation',
-                'Value': object_request_body,
-                'Type': 8,
-                'Id': object_attribute_id
-            }
-        ]
+        self.request_body_prefix = request_body_prefix
+        self.schema = schema
+        self.request_body = None
+        self.search = search
+        self.created = False
         if mode == 'mto':
-            self.name = self.attributes_value['Номенклатурная позиция']
-            self.request_body.append(
-                {
-                    'Name': 'forvalidation',
-                    'Value': level_one_name,
-                    'Type': 2,
-                    'Id': level_one_name_attribute_id
-                },
-            )
+            self.name = self.attributes_value[schema.index['Номенклатурная позиция']]
+        elif mode == 'delivery_order' or mode == 'notification':
+            self.name = self.attributes_value[schema.index['Потребность.Номенклатура.Наименование']]
+        else:
+            self.name = None
         self.neosintez_id = None
-        if mode == 'delivery_order' or mode == 'notification':
-            self.name = self.attributes_value['Потребность.Номенклатура.Наименование']
 
     def __str__(self):
         return self.key
 
+    @staticmethod
+    def get_template(schema):
+        """
+        Функция get_template возвращает шаблон атрибутов тела запроса записи атрибутов, один раз за процесс.
+        Для каждого атрибута мэпинга шаблон содержит кортеж (id, тип, позиция колонки в строке, регулярное выражение,
+        функция преобразования значения, атрибут).
+
+        :param schema: Схема строк данных
+        :return: Список кортежей
+        """
+        if Item.TEMPLATE is None:
+            func_dict = {
+                1: Item.float_atr,
+                2: Item.str_atr,
+                3: Item.str_atr,
+                5: Item.str_atr,
+                8: Item.ref_atr,
+            }
+            Item.TEMPLATE = [
+                (attribute['id'], attribute['type'], position, str(attribute['regexp']) if attribute['regexp'] else None,
+                 func_dict.get(attribute['type'], Item.str_atr), attribute)
+                for attribute, position in zip(LevelOne.load_mapping_data(), schema.request_positions)
+            ]
+        return Item.TEMPLATE
+
     def get_request_body(self):
-        func_dict = {
-            1: self.float_atr,
-            2: self.str_atr,
-            3: self.str_atr,
-            5: self.str_atr,
-            8: self.ref_atr,
-        }
-        for attribute in self.mapping_data:
-            atr_value = self.attributes_value.get(attribute['name'])
-            atr_id = attribute['id']
-            atr_type = attribute['type']
+        """
+        Функция get_request_body заполняет шаблон атрибутов значениями строки attributes_value
+        и формирует тело запроса: общее начало request_body_prefix и атрибуты мэпинга.
+        """
+        request_body = list(self.request_body_prefix)
+        for atr_id, atr_type, position, regexp, func, attribute in self.get_template(self.schema):
+            atr_value = None if position is None else self.attributes_value[position]
             if atr_value:
-                if attribute['regexp']:
-                    atr_value = self.get_by_re(atr_value, str(attribute['regexp']))
-
-                atr_value = func_dict.get(atr_type, self.str_atr)(value=atr_value, atr=attribute)
+                if regexp:
+                    atr_value = self.get_by_re(atr_value, regexp)
 
-            # # пропустить если значение пустое
-            # if not atr_value:
-            #     continue
+                atr_value = func(value=atr_value, atr=attribute)
 
-            atr_body = {
+            request_body.append({
                 'Name': 'forvalidation',
                 'Value': atr_value,
                 'Type': atr_type,
                 'Id': atr_id
-            }
-            self.request_body.append(atr_body)
+            })
+        self.request_body = request_body
 
     def push_into_neosintez(self):
         """
         Функция push_into_neosintez используется для переноса данных из исходной системы в Neosintez.
-            Сначала она проверяет, существует ли neosintez_id для данного элемента, и если нет, то создает его.
-            Затем она получает тело запроса (атрибуты) и помещает их в Neosintez.
+            Сначала она получает тело запроса (атрибуты) и ищет объект по ключу, если neosintez_id для данного элемента не известен.
+            Найденный объект обновляется записью атрибутов, а ненайденный создается сразу с ключом и атрибутами.
         
         :param self: Экземпляр класса
         """
+        self.get_request_body()
         if self.neosintez_id is None:
-            name = self.name if mode != 'appius' else self.key
-            self.neosintez_id = self.get_id_by_key(self.parent_id, item_class_id, name, self.key, key_attribute_id)
+            self.neosintez_id = self.search_by_key(self.parent_id, item_class_id, self.key, key_attribute_id) \
+                if self.search else ''
+            if self.neosintez_id == '':
+                name = self.name if mode != 'appius' else self.key
+                request_body = self.get_key_request_body(self.key, key_attribute_id) + self.request_body
+                self.neosintez_id = self.create_in_neosintez(self.parent_id, item_class_id, name, request_body)
+                if self.neosintez_id:
+                    self.created = True
+                    Metrics.count('objects_created')
+                else:
+                    Metrics.count('objects_failed')
+                return
 
-        self.get_request_body()
-        self.put_attributes(self.neosintez_id, self.request_body)
+        response = self.put_attributes(self.neosintez_id, self.request_body)
+        if response.status_code == 200:
+            Metrics.count('objects_updated')
+        else:
+            Metrics.count('objects_failed')
+
+
+class FilesWatcher:
+    """
+    Класс FilesWatcher отслеживает файлы выгрузки каталога в режиме --watch.
+    Файл считается готовым, когда его размер и время изменения не менялись debounce секунд: 1С дописала файл.
+    Готовый файл выдается один раз, до следующего изменения.
+
+    :param directory: Каталог файлов выгрузки
+    :param debounce: Время без изменений файла, секунды
+    """
+
+    def __init__(self, directory, debounce):
+        self.directory = directory
+        self.debounce = debounce
+        # {имя файла: ((размер, время изменения), время первого наблюдения этого состояния по time.monotonic)}
+        self.pending = {}
+        # {имя файла: (размер, время изменения)} выданных готовых файлов
+        self.processed = {}
+
+    def get_snapshot(self):
+        """Функция get_snapshot возвращает {имя файла: (размер, время изменения)} файлов каталога, как get_files_index"""
+        with os.scandir(self.directory) as entries:
+            return {entry.name: (entry.stat().st_size, entry.stat().st_mtime_ns) for entry in entries
+                    if entry.is_file() and '~' not in entry.name}
+
+    def poll(self):
+        """
+        Функция poll сравнивает текущее состояние каталога с предыдущими опросами.
+
+        :return: Словарь {имя файла: (размер, время изменения)} файлов, готовых к загрузке
+        """
+        now = time.monotonic()
+        snapshot = self.get_snapshot()
+        ready = {}
+        for name, f_stat in snapshot.items():
+            if self.processed.get(name) == f_stat:
+                continue
+            state = self.pending.get(name)
+            if state is None or state[0] != f_stat:
+                self.pending[name] = (f_stat, now)
+            elif now - state[1] >= self.debounce:
+                del self.pending[name]
+                ready[name] = f_stat
+        for name in set(self.pending) - set(snapshot):
+            del self.pending[name]
+        for name in set(self.processed) - set(snapshot):
+            del self.processed[name]
+        return ready
+
+    def mark_processed(self, files):
+        """
+        Функция mark_processed запоминает состояние выданных файлов, чтобы не загружать их снова без изменений.
+
+        :param files: Словарь {имя файла: (размер, время изменения)}
+        """
+        self.processed.update(files)
+
+
+def parse_level_one_file(name, f_path):
+    """
+    Функция parse_level_one_file разбирает файл выгрузки LevelOne в процессе пула, см. LevelOne.start_parsing.
+
+    :param name: Имя LevelOne
+    :param f_path: Путь к файлу
+    :return: Кортеж (строки файла до объединения дублей ключей, длительность разбора в секундах,
+        размер и время изменения файла при чтении)
+    """
+    level_one = LevelOne(name, None, None)
+    level_one.f_path = f_path
+    started = time.perf_counter()
+    data = level_one.read_new_items_data()
+    return data, time.perf_counter() - started, level_one.f_stat
+
+
+def rename_free_balance_file(file):
+    """
+    Функция rename_free_balance_file переименовывает выгрузку СвободныеОстатки.xlsx в ИЗП_СО_ЗО.xlsx - файл LevelOne ИЗП_СО.
+
+    :param file: Имя файла каталога files_directory
+    :return: Имя файла после переименования
+    """
+    if file != 'СвободныеОстатки.xlsx':
+        return file
+    new_name = 'ИЗП_СО_ЗО.xlsx'
+    os.replace(files_directory + file, files_directory + new_name)
+    return new_name
+
+
+def process_level_one(level_one):
+    """
+    Функция process_level_one загружает файл LevelOne: чтение файла, сравнение с данными Neosintez,
+    удаление, обновление и создание объектов и перенос файла в prev, в режиме --plan - расчет плана изменений.
+
+    :param level_one: Экземпляр LevelOne
+    """
+    logging.info(f'Processing level one {level_one.name}')
+    Metrics.set_context(level_one.parent, level_one.name)
+
+    with Metrics.timer('get_file_path'):
+        level_one.get_file_path()
+    if not level_one.f_path:
+        logging.warning('File is not found')
+        return
+
+    with Metrics.timer('get_new_items_data'):
+        level_one.get_new_items_data()
+
+    if not level_one.new_data:
+        logging.warning('File is empty')
+        if plan:
+            return
+        level_one.delete_file()
+        logging.info('File is queued for moving to prev folder')
+        return
+
+    logging.info(f'Total rows in new input file {len(level_one.new_data)}')
+    Metrics.count('rows_read', len(level_one.new_data))
+
+    with Metrics.timer('get_current_items_data'):
+        level_one.get_current_items_data()
+    logging.info(f'Total entities in neosintez at beginning {len(level_one.current_data)}')
+    Metrics.count('objects_fetched', len(level_one.current_data))
+
+    with Metrics.timer('get_update_data'):
+        level_one.get_update_data()
+    logging.info(f'Total entities for update {len(level_one.update_data)}')
+    Metrics.count('objects_for_update', len(level_one.update_data))
+
+    with Metrics.timer('get_delete_items'):
+        level_one.get_delete_items()
+    logging.info(f'Total rows for delete {len(level_one.delete_items_id)}')
+    Metrics.count('objects_for_delete', len(level_one.delete_items_id))
+
+    if plan:
+        level_one_plan = level_one.get_plan()
+        LevelOne.PLANS.append(level_one_plan)
+        logging.info(f'Plan: create {len(level_one_plan["create"])}, update {len(level_one_plan["update"])}, '
+                     f'delete {len(level_one_plan["delete"])}, requests {level_one_plan["requests"]}')
+        return
+
+    logging.info('Deleting')
+    with Metrics.timer('delete_items'):
+        deleted_counter = level_one.delete_items()
+    logging.info(f'Deleting complete. Deleted {deleted_counter}')
+    Metrics.count('objects_deleted', deleted_counter)
+
+    logging.info('Updating')
+    with Metrics.timer('get_level_two_names'):
+        level_one.get_level_two_names()
+    with Metrics.timer('push_into_neosintez'):
+        level_one.push_into_neosintez()
+    with Metrics.timer('total_in_neosintez'):
+        total_in_neosintez = level_one.total_in_neosintez
+    logging.info(f'Updating complete. Total in neosintez {total_in_neosintez}')
+
+    with Metrics.timer('delete_file'):
+        level_one.delete_file()
+    logging.info('File is queued for moving to prev folder')
+
+
+def save_run_metrics():
+    """Функция save_run_metrics сохраняет сводку метрик запуска и, если указан prometheus_textfile, метрики Prometheus"""
+    Metrics.set_context()
+    logging.info(f'Run summary is saved in {Metrics.save_summary()}')
+    if prometheus_textfile:
+        Metrics.save_prometheus(prometheus_textfile)
+        logging.info(f'Prometheus metrics are saved in {prometheus_textfile}')
+
+
+def watch_files(watcher):
+    """
+    Функция watch_files - режим --watch после полной загрузки. Каталог files_directory опрашивается каждые watch_interval
+    секунд, и загружаются только LevelOne, файлы которых изменились и не менялись watch_debounce секунд (см. FilesWatcher).
+    Сессия, токен, корни и значения ссылочных атрибутов сохраняются между загрузками: токен обновляется
+    до окончания действия, корни и значения ссылочных атрибутов - раз в watch_roots_interval секунд,
+    мэпинг атрибутов - при изменении attributes_file.
+    Для каждой загрузки создаются новые LevelOne и сохраняется отдельная сводка метрик.
+    Работает до прерывания процесса (Ctrl+C между загрузками).
+
+    :param watcher: Экземпляр FilesWatcher с состоянием каталога до полной загрузки
+    """
+    roots_loaded = time.monotonic()
+    logging.info(f'Watching {files_directory} every {watch_interval} s')
+    while True:
+        try:
+            time.sleep(watch_interval)
+        except KeyboardInterrupt:
+            logging.info('Watching is stopped')
+            return
+        ready = watcher.poll()
+        if not ready:
+            continue
+        ready = {rename_free_balance_file(name): f_stat for name, f_stat in ready.items()}
+        watcher.mark_processed(ready)
+        Metrics.reset()
+        logging.info(f'Changed files {sorted(ready)}')
+        try:
+            Neosintez.refresh_token()
+            if LevelOne.reset_mapping_if_changed():
+                logging.info(f'Mapping file {attributes_file} is changed and will be reloaded')
+            if time.monotonic() - roots_loaded > watch_roots_interval:
+                Neosintez.ROOTS.clear()
+                Neosintez.REFERENCES.clear()
+                with Metrics.timer('get_roots_from_neosintez'):
+                    Neosintez.get_roots_from_neosintez()
+                roots_loaded = time.monotonic()
+                logging.info(f'Total main roots {len(Neosintez.ROOTS)}')
+            # каталог и объекты корней читаются заново, LevelOne создаются заново:
+            # после загрузки прежние данные и счетчики LevelOne устарели
+            LevelOne.FILES_INDEX = None
+            LevelOne.ROOT_PARTITIONS = {}
+            levels_one = list()
+            for root in Neosintez.ROOTS:
+                for name in root.keys_list:
+                    level_one = LevelOne(name, root.root_id, root.object_request_body)
+                    level_one.get_file_path()
+                    if level_one.f_path and os.path.basename(level_one.f_path) in ready:
+                        levels_one.append(level_one)
+            LevelOne.set_root_wide(levels_one)
+            if excel_workers != 1 and not Profiler.ENABLED:
+                LevelOne.start_parsing(levels_one, excel_workers)
+            for level_one in levels_one:
+                try:
+                    process_level_one(level_one)
+                except Exception:
+                    logging.exception('Error occurred')
+        except Exception:
+            logging.exception('Error occurred')
+        finally:
+            LevelOne.stop_parsing()
+            if LevelOne.ARCHIVE_FUTURES:
+                logging.info(f'Files moved to prev folder {LevelOne.wait_archiving()}')
+            save_run_metrics()
 
 
 def get_time():
@@ -917,17 +3085,36 @@ def get_time():
     return f'{datetime.now().strftime("%Y-%m-%d")}'
 
 
+def get_run_file_name(name):
+    """Функция возвращает путь к файлу запуска в каталоге logs_path вида Y-m-d_H.M.S_<config suffix>_<name>"""
+    return logs_path + Metrics.STARTED.strftime('%Y-%m-%d_%H.%M.%S') + f'_{config_file_name_suffix}_{name}'
+
+
 # mode может принимать значения appius или mto или delivery_order или notification
 DEBUG = False
+# флаги запуска, передаются после mode и config suffix
+OPTIONS = (
+    '--profile',  # профилирование этапов через cProfile
+    '--profile-memory',  # профилирование этапов и пиковой памяти через tracemalloc
+    '--record',  # запись запросов к API в кассету
+    '--replay',  # воспроизведение ответов API из кассеты без обращения к серверу
+    '--plan',  # расчет плана изменений без записи в Неосинтез и без переноса файлов в prev
+    '--watch',  # после полной загрузки ожидание и загрузка измененных файлов выгрузки
+)
+
+options = [arg for arg in sys.argv[1:] if arg.startswith('--')]
+arguments = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+if set(options) - set(OPTIONS):
+    raise EnvironmentError(f'Неизвестные флаги запуска {sorted(set(options) - set(OPTIONS))}, допустимые флаги {OPTIONS}')
 
 if DEBUG:
     mode = 'appius'
     config_file_name_suffix = mode
-elif len(sys.argv) != 3 and not DEBUG:
+elif len(arguments) != 2 and not DEBUG:
     raise EnvironmentError('При запуске должны быть переданы два аргумента: mode и config suffix')
 else:
-    mode = sys.argv[1]
-    config_file_name_suffix = sys.argv[2]
+    mode = arguments[0]
+    config_file_name_suffix = arguments[1]
 
 with open(f'config_{config_file_name_suffix}.json', encoding='utf-8') as config:
     config_dict = json.loads(config.read())
@@ -947,71 +3134,137 @@ object_attribute_id = config_dict['object_attribute_id']
 bin_item_id = config_dict['bin_item_id']
 key_column_name = config_dict['key_column_name']
 level_one_name_attribute_id = config_dict['level_one_name_attribute_id']
-
-logging.basicConfig(
-    format='%(asctime)s : %(levelname)s : %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler(logs_path + get_time() + f'_{config_file_name_suffix}.log'),
-        logging.StreamHandler()
-    ]
-)
-
-for file in os.listdir(files_directory):
-    if file == 'СвободныеОстатки.xlsx':
-        old_name = files_directory + file
-        new_name = files_directory + 'ИЗП_СО_ЗО.xlsx'
-        os.replace(old_name, new_name)
-
-try:
-    Neosintez.get_token()
-    Neosintez.get_roots_from_neosintez()
-    logging.info(f'Total main roots {len(Neosintez.ROOTS)}')
-    for root in Neosintez.ROOTS:
-        try:
-            logging.info(f'Processing main root {root.root_id}')
-            for level_one in root.levels_one:
-                logging.info(f'Processing level one {level_one.name}')
-
-                level_one.get_file_path()
-                if not level_one.f_path:
-                    logging.warning('File is not found')
-                    continue
-
-                level_one.get_new_items_data()
-
-                if not level_one.new_data:
-                    logging.warning('File is empty')
-                    level_one.delete_file()
-                    logging.info('File is copied in prev folder')
-                    continue
-
-                logging.info(f'Total rows in new input file {len(level_one.new_data)}')
-
-                level_one.get_current_items_data()
-                logging.info(f'Total entities in neosintez at beginning {len(level_one.current_data)}')
-
-                level_one.get_update_data()
-                logging.info(f'Total entities for update {len(level_one.update_data)}')
-
-                level_one.get_delete_items()
-                logging.info(f'Total rows for delete {len(level_one.delete_items_id)}')
-                logging.info('Deleting')
-                deleted_counter = level_one.delete_items()
-                logging.info(f'Deleting complete. Deleted {deleted_counter}')
-
-                logging.info('Updating')
-                level_one.get_level_two_names()
-                level_one.push_into_neosintez()
-                logging.info(f'Updating complete. Total in neosintez {level_one.total_in_neosintez}')
-
-                level_one.delete_file()
-                logging.info('File is copied in prev folder')
-
-        except Exception as e:
-
-            print(e)
-            logging.exception('Error occurred')
-finally:
-    Neosintez.SESSION.close()
-    logging.info('Session is closed')
+# необязательные параметры
+prometheus_textfile = config_dict.get('prometheus_textfile', '')
+cassette_file = config_dict.get('cassette_file', '')
+cassette_latency_scale = config_dict.get('cassette_latency_scale', 1.0)
+retry_count = config_dict.get('retry_count', 5)
+retry_backoff = config_dict.get('retry_backoff', 0.5)
+retry_backoff_max = config_dict.get('retry_backoff_max', 30)
+# максимальная пауза по заголовку Retry-After, секунды
+retry_after_max = config_dict.get('retry_after_max', 3600)
+rate_limit_max = config_dict.get('rate_limit_max', 0)
+rate_limit_min = config_dict.get('rate_limit_min', 1)
+circuit_breaker_threshold = config_dict.get('circuit_breaker_threshold', 10)
+circuit_breaker_timeout = config_dict.get('circuit_breaker_timeout', 60)
+http_pool_connections = config_dict.get('http_pool_connections', 10)
+http_pool_maxsize = config_dict.get('http_pool_maxsize', 10)
+http_connect_timeout = config_dict.get('http_connect_timeout', 10)
+# таймаут чтения ответа, секунды, None - без ограничения: поиск по корню с большим take может выполняться
+# дольше любого таймаута, а после таймаута запрос повторяется и снова нагружает сервер
+http_read_timeout = config_dict.get('http_read_timeout', None)
+# минимальный размер тела PUT запроса для сжатия gzip, 0 - не сжимать
+gzip_request_min_size = config_dict.get('gzip_request_min_size', 0)
+search_projection = config_dict.get('search_projection', True)
+create_with_attributes = config_dict.get('create_with_attributes', True)
+# режим mto: один постраничный поиск объектов по корню вместо поиска для каждого LevelOne, если файлы есть хотя бы
+# у двух LevelOne корня
+root_wide_fetch = config_dict.get('root_wide_fetch', True)
+search_page_size = config_dict.get('search_page_size', 10000)
+# строки файла с одинаковым ключом: last - последняя, first - первая, sum - последняя с суммой числовых колонок
+duplicate_keys_policy = config_dict.get('duplicate_keys_policy', 'last')
+if duplicate_keys_policy not in ('last', 'first', 'sum'):
+    raise ValueError(f'Unknown duplicate_keys_policy {duplicate_keys_policy}, expected last, first or sum')
+duplicate_keys_sum_columns = config_dict.get('duplicate_keys_sum_columns', [])
+# число процессов разбора файлов выгрузки: 0 - по числу ядер, 1 - разбор в основном процессе
+excel_workers = config_dict.get('excel_workers', 0)
+# попытки чтения файла выгрузки, который 1С перезаписывает во время чтения, и пауза между ними, секунды
+staging_attempts = config_dict.get('staging_attempts', 3)
+staging_retry_delay = config_dict.get('staging_retry_delay', 5)
+# режим --watch: период опроса каталога, время без изменений файла и период обновления корней, секунды
+watch_interval = config_dict.get('watch_interval', 5)
+watch_debounce = config_dict.get('watch_debounce', 10)
+watch_roots_interval = config_dict.get('watch_roots_interval', 3600)
+# кэш корней: время жизни, секунды, и файл. По умолчанию 0 - корни запрашиваются при каждом запуске.
+# Изменения списков LevelOne корней в Neosintez при включенном кэше загружаются только после истечения roots_cache_ttl,
+# если число корней не изменилось
+roots_cache_ttl = config_dict.get('roots_cache_ttl', 0)
+roots_cache_file = config_dict.get('roots_cache_file', logs_path + f'{config_file_name_suffix}_roots.cache.json')
+
+# при разборе файлов в пуле процессов модуль импортируется в каждом процессе пула, загрузка выполняется только в основном
+if __name__ == '__main__':
+    logging.basicConfig(
+        format='%(asctime)s : %(levelname)s : %(message)s',
+        level=logging.INFO,
+        handlers=[
+            logging.FileHandler(logs_path + get_time() + f'_{config_file_name_suffix}.log'),
+            logging.StreamHandler()
+        ]
+    )
+
+    for file in os.listdir(files_directory):
+        rename_free_balance_file(file)
+
+    if '--profile' in options or '--profile-memory' in options:
+        Profiler.start(memory='--profile-memory' in options)
+
+    plan = '--plan' in options
+    watch = '--watch' in options
+    if watch and (plan or '--replay' in options):
+        raise EnvironmentError('Флаг --watch не может быть передан вместе с --plan или --replay')
+    Neosintez.LIMITER = AdaptiveRateLimiter(rate_limit_max, rate_limit_min)
+    Neosintez.GZIP_REQUESTS = bool(gzip_request_min_size)
+    Neosintez.BREAKER = CircuitBreaker(circuit_breaker_threshold, circuit_breaker_timeout)
+
+    if '--record' in options and '--replay' in options:
+        raise EnvironmentError('Флаги --record и --replay не могут быть переданы одновременно')
+    elif '--record' in options:
+        Neosintez.CASSETTE = CassetteAdapter(CassetteAdapter.RECORD, cassette_file or get_run_file_name('cassette.jsonl.gz'),
+                                             pool_connections=http_pool_connections, pool_maxsize=http_pool_maxsize)
+    elif '--replay' in options:
+        if not cassette_file:
+            raise EnvironmentError('Для флага --replay в конфиге должен быть указан cassette_file')
+        Neosintez.CASSETTE = CassetteAdapter(CassetteAdapter.REPLAY, cassette_file, cassette_latency_scale)
+
+    if watch:
+        # состояние каталога до полной загрузки: файлы, записанные во время нее, загружаются в режиме --watch
+        watcher = FilesWatcher(files_directory, watch_debounce)
+        watcher.mark_processed(watcher.get_snapshot())
+
+    watching = False
+    try:
+        with Metrics.timer('get_token'):
+            Neosintez.get_token()
+        with Metrics.timer('get_roots_from_neosintez'):
+            Neosintez.get_roots_from_neosintez()
+        logging.info(f'Total main roots {len(Neosintez.ROOTS)}')
+        LevelOne.set_root_wide([level_one for root in Neosintez.ROOTS for level_one in root.levels_one])
+        # cProfile и tracemalloc не видят разбор в других процессах
+        if excel_workers != 1 and not Profiler.ENABLED:
+            LevelOne.start_parsing([level_one for root in Neosintez.ROOTS for level_one in root.levels_one],
+                                   excel_workers)
+        for root in Neosintez.ROOTS:
+            try:
+                logging.info(f'Processing main root {root.root_id}')
+                for level_one in root.levels_one:
+                    process_level_one(level_one)
+
+            except Exception as e:
+
+                print(e)
+                logging.exception('Error occurred')
+        if watch:
+            LevelOne.stop_parsing()
+            if LevelOne.ARCHIVE_FUTURES:
+                logging.info(f'Files moved to prev folder {LevelOne.wait_archiving()}')
+            save_run_metrics()
+            watching = True
+            watch_files(watcher)
+    finally:
+        LevelOne.stop_parsing()
+        if LevelOne.ARCHIVE_FUTURES:
+            logging.info(f'Files moved to prev folder {LevelOne.wait_archiving()}')
+        Neosintez.SESSION.close()
+        logging.info('Session is closed')
+        # в режиме --watch сводка сохраняется после каждой загрузки
+        if not watching:
+            save_run_metrics()
+        if plan:
+            logging.info(f'Plan is saved in {LevelOne.save_plans()}')
+        if Profiler.ENABLED:
+            logging.info(f'Profiles are saved in {Profiler.save()}')
+        if Neosintez.CASSETTE and Neosintez.CASSETTE.cassette_mode == CassetteAdapter.RECORD:
+            Neosintez.CASSETTE.save()
+            logging.info(f'{len(Neosintez.CASSETTE.records)} requests are recorded in {Neosintez.CASSETTE.file_name}')
+        elif Neosintez.CASSETTE:
+            logging.info(f'Replay complete. Requests without recorded response {Neosintez.CASSETTE.misses}')
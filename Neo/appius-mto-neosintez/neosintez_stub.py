@@ -0,0 +1,396 @@
+"""
+Локальная замена API Neosintez для отладки и замеров производительности без рабочего сервера.
+Реализует запросы, которые использует main.py: connect/token, api/objects/search (Filters/Conditions, take/skip, отбор атрибутов Attributes),
+api/objects?parent= (создание, в том числе с Attributes), api/objects/{id}/attributes (PUT) и DELETE api/objects/{id}.
+Данные хранятся в памяти. Задержка ответа, доля ошибок и ограничение частоты запросов задаются параметрами запуска.
+
+Запуск:
+    python neosintez_stub.py --port 5000 --seed seed.json --latency 0.01 --error-rate 0.01 --rate-limit 200
+
+В конфиге main.py указывается "url": "http://127.0.0.1:5000/".
+Служебные запросы заглушки:
+    GET /stub/stats - счетчики запросов по типам
+    POST /stub/objects - добавить объекты (список словарей в формате seed файла)
+    POST /stub/reset - очистить данные и счетчики
+"""
+import argparse
+import gzip
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+
+class Storage:
+    """
+    Хранилище объектов в памяти.
+    Объект хранится в виде словаря с ключами Id, Name, Entity, Parent, Attributes.
+    Для поиска поддерживаются индексы по классу, имени и значениям атрибутов.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.objects = {}
+        # {id: [id предков]}
+        self.ancestors = {}
+        # {id: set(id дочерних объектов)}
+        self.children = {}
+        # {class_id: set(id)}
+        self.by_class = {}
+        # {name: set(id)}
+        self.by_name = {}
+        # {(attribute_id, value): set(id)}
+        self.by_value = {}
+
+    @staticmethod
+    def _index_value(value):
+        if isinstance(value, dict):
+            value = value.get('Name')
+        return str(value)
+
+    def add(self, name, class_id, parent_id=None, object_id=None, attributes=None):
+        """
+        Функция add создает объект.
+
+        :param name: Имя объекта
+        :param class_id: Класс объекта
+        :param parent_id: Родительский объект
+        :param object_id: Идентификатор объекта, если не указан - генерируется
+        :param attributes: Словарь атрибутов вида {id: {'Value': ..., 'Type': ...}}
+        :return: Созданный объект
+        """
+        with self.lock:
+            object_id = object_id or str(uuid.uuid4())
+            item = {
+                'Id': object_id,
+                'Name': name,
+                'Entity': {'Id': class_id, 'Name': class_id},
+                'Parent': parent_id,
+                'Attributes': {},
+            }
+            self.objects[object_id] = item
+            self.ancestors[object_id] = (self.ancestors.get(parent_id, []) + [parent_id]) if parent_id else []
+            self.children.setdefault(object_id, set())
+            if parent_id:
+                self.children.setdefault(parent_id, set()).add(object_id)
+            self.by_class.setdefault(class_id, set()).add(object_id)
+            self.by_name.setdefault(name, set()).add(object_id)
+            for attribute_id, attribute in (attributes or {}).items():
+                self.set_attribute(object_id, attribute_id, attribute['Value'], attribute['Type'])
+            return item
+
+    def set_attribute(self, object_id, attribute_id, value, atr_type):
+        """
+        Функция set_attribute записывает значение атрибута так, как его вернул бы Neosintez:
+        даты приводятся к виду Y-m-dTH:M:S, для ссылок подставляется имя объекта справочника,
+        пустое значение удаляет атрибут.
+        """
+        with self.lock:
+            attributes = self.objects[object_id]['Attributes']
+            old = attributes.pop(attribute_id, None)
+            if old is not None:
+                self.by_value.get((attribute_id, self._index_value(old['Value'])), set()).discard(object_id)
+            if value is None or value == '':
+                return
+            if atr_type in (3, 5) and isinstance(value, str) and len(value) == 10:
+                value = value + 'T00:00:00'
+            elif atr_type == 8 and isinstance(value, dict):
+                reference = self.objects.get(value.get('Id'))
+                value = {'Id': value.get('Id'), 'Name': reference['Name'] if reference else value.get('Name')}
+            attributes[attribute_id] = {'Value': value, 'Type': atr_type}
+            self.by_value.setdefault((attribute_id, self._index_value(value)), set()).add(object_id)
+
+    def delete(self, object_id):
+        """Функция delete удаляет объект вместе с вложенными объектами"""
+        with self.lock:
+            item = self.objects.pop(object_id, None)
+            if item is None:
+                return False
+            for child_id in list(self.children.pop(object_id, ())):
+                self.delete(child_id)
+            if item['Parent']:
+                self.children.get(item['Parent'], set()).discard(object_id)
+            self.ancestors.pop(object_id, None)
+            self.by_class.get(item['Entity']['Id'], set()).discard(object_id)
+            self.by_name.get(item['Name'], set()).discard(object_id)
+            for attribute_id, attribute in item['Attributes'].items():
+                self.by_value.get((attribute_id, self._index_value(attribute['Value'])), set()).discard(object_id)
+            return True
+
+    def search(self, payload):
+        """
+        Функция search отбирает объекты по Filters (Type 4 - вложенность в узел, Type 5 - класс)
+        и Conditions (Type 1 - значение атрибута, Type 2 - имя; Operator 1 - равно, Operator 7 - заполнено).
+
+        :param payload: Тело поискового запроса
+        :return: Список объектов
+        """
+        with self.lock:
+            candidates = None
+            checks = []
+            for search_filter in payload.get('Filters', []):
+                if search_filter['Type'] == 5:
+                    candidates = self._intersect(candidates, self.by_class.get(search_filter['Value'], set()))
+                elif search_filter['Type'] == 4:
+                    parent_id = search_filter['Value']
+                    checks.append(lambda object_id, parent_id=parent_id: parent_id in self.ancestors[object_id])
+            for condition in payload.get('Conditions', []):
+                operator = condition.get('Operator', 1)
+                if condition['Type'] == 2:
+                    candidates = self._intersect(candidates, self.by_name.get(condition['Value'], set()))
+                elif operator == 1:
+                    key = (condition['Attribute'], self._index_value(condition['Value']))
+                    candidates = self._intersect(candidates, self.by_value.get(key, set()))
+                elif operator == 7:
+                    attribute_id = condition['Attribute']
+                    checks.append(lambda object_id, attribute_id=attribute_id:
+                                  attribute_id in self.objects[object_id]['Attributes'])
+            if candidates is None:
+                candidates = self.objects.keys()
+            return [self.objects[object_id] for object_id in sorted(candidates)
+                    if all(check(object_id) for check in checks)]
+
+    @staticmethod
+    def _intersect(candidates, ids):
+        return set(ids) if candidates is None else candidates & ids
+
+
+class Stub:
+    """
+    Параметры поведения заглушки и счетчики запросов.
+
+    :param latency: Задержка ответа, секунды
+    :param jitter: Случайная добавка к задержке, секунды
+    :param error_rate: Доля запросов к api, на которые возвращается ошибка 500
+    :param rate_limit: Допустимое число запросов в секунду, сверх него возвращается 429 с Retry-After, 0 - без ограничения
+    :param gzip: Сжимать ответы, если клиент их принимает (Accept-Encoding: gzip); сжатые тела запросов принимаются всегда
+    :param projection: Учитывать отбор атрибутов Attributes в поисковом запросе, иначе поле игнорируется
+    :param create_attributes: Записывать атрибуты Attributes из запроса создания объекта, иначе поле игнорируется
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit=0, gzip=True, projection=True,
+                 create_attributes=True):
+        self.storage = Storage()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.gzip = gzip
+        self.projection = projection
+        self.create_attributes = create_attributes
+        self.lock = threading.Lock()
+        self.tokens = float(rate_limit)
+        self.tokens_time = time.monotonic()
+        self.stats = {}
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + 1
+
+    def reset(self):
+        with self.lock:
+            self.storage = Storage()
+            self.stats = {}
+
+    def throttle(self):
+        """
+        Функция throttle реализует ограничение частоты запросов по алгоритму token bucket.
+
+        :return: Время в секундах до появления свободного места или 0, если запрос можно выполнить
+        """
+        if not self.rate_limit:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(float(self.rate_limit), self.tokens + (now - self.tokens_time) * self.rate_limit)
+            self.tokens_time = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate_limit
+
+    def load_seed(self, objects):
+        """
+        Функция load_seed добавляет объекты из списка словарей вида
+        {"Id": ..., "Name": ..., "Entity": class_id, "Parent": parent_id, "Attributes": {id: {"Value": ..., "Type": ...}}}.
+        """
+        for item in objects:
+            self.storage.add(item['Name'], item['Entity'], item.get('Parent'), item.get('Id'), item.get('Attributes'))
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    stub: Stub = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b''
+        if body and self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return body
+
+    def _send(self, status, body=None, headers=None):
+        data = b'' if body is None else json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        if self.stub.gzip and len(data) > 1024 and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            data = gzip.compress(data, compresslevel=1)
+            self.send_header('Content-Encoding', 'gzip')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, method):
+        parts = urlsplit(self.path)
+        path = parts.path.strip('/')
+        query = parse_qs(parts.query)
+        body = self._read_body()
+        stub = self.stub
+
+        if path.startswith('stub/'):
+            return self._handle_service(method, path, body)
+
+        if path.startswith('api/'):
+            retry_after = stub.throttle()
+            if retry_after:
+                stub.count('throttled')
+                return self._send(429, {'Message': 'Too many requests'}, {'Retry-After': str(math.ceil(retry_after))})
+            if stub.latency or stub.jitter:
+                time.sleep(stub.latency + random.random() * stub.jitter)
+            if stub.error_rate and random.random() < stub.error_rate:
+                stub.count('errors')
+                return self._send(500, {'Message': 'Injected error'})
+
+        if method == 'POST' and path == 'connect/token':
+            stub.count('token')
+            return self._send(200, {'access_token': 'stub-token', 'token_type': 'Bearer', 'expires_in': 3600})
+        if method == 'POST' and path == 'api/objects/search':
+            stub.count('search')
+            return self._search(query, json.loads(body or b'{}'))
+        if method == 'POST' and path == 'api/objects':
+            stub.count('create')
+            return self._create(query, json.loads(body or b'{}'))
+
+        segments = path.split('/')
+        if len(segments) >= 3 and segments[:2] == ['api', 'objects']:
+            object_id = segments[2]
+            if object_id not in stub.storage.objects:
+                return self._send(404, {'Message': f'Object {object_id} is not found'})
+            if method == 'PUT' and segments[3:] == ['attributes']:
+                stub.count('put')
+                for attribute in json.loads(body or b'[]'):
+                    stub.storage.set_attribute(object_id, attribute['Id'], attribute['Value'], attribute['Type'])
+                return self._send(200)
+            if method == 'DELETE' and len(segments) == 3:
+                stub.count('delete')
+                stub.storage.delete(object_id)
+                return self._send(200)
+        return self._send(404, {'Message': f'Unknown request {method} {self.path}'})
+
+    def _search(self, query, payload):
+        take = int(query.get('take', ['100'])[0])
+        skip = int(query.get('skip', ['0'])[0])
+        result = self.stub.storage.search(payload)
+        page = result[skip:skip + take]
+        projection = payload.get('Attributes') if self.stub.projection else None
+        if projection is not None:
+            projection = set(projection)
+        objects = []
+        for item in page:
+            item = {key: value for key, value in item.items() if key != 'Parent'}
+            if projection is not None:
+                item['Attributes'] = {key: value for key, value in item['Attributes'].items() if key in projection}
+            objects.append({'Object': item})
+        self._send(200, {'Total': len(result), 'Result': objects})
+
+    def _create(self, query, payload):
+        parent_id = query.get('parent', [None])[0]
+        if parent_id not in self.stub.storage.objects:
+            return self._send(400, {'Message': f'Parent {parent_id} is not found'})
+        item = self.stub.storage.add(payload['Name'], payload['Entity']['Id'], parent_id)
+        if self.stub.create_attributes:
+            for attribute_id, attribute in (payload.get('Attributes') or {}).items():
+                self.stub.storage.set_attribute(item['Id'], attribute_id, attribute['Value'], attribute['Type'])
+        self._send(200, {'Id': item['Id'], 'Name': item['Name']})
+
+    def _handle_service(self, method, path, body):
+        if method == 'GET' and path == 'stub/stats':
+            return self._send(200, dict(self.stub.stats, objects=len(self.stub.storage.objects)))
+        if method == 'POST' and path == 'stub/objects':
+            self.stub.load_seed(json.loads(body))
+            return self._send(200)
+        if method == 'POST' and path == 'stub/reset':
+            self.stub.reset()
+            return self._send(200)
+        return self._send(404, {'Message': f'Unknown request {method} {self.path}'})
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+
+def serve(host='127.0.0.1', port=5000, stub=None):
+    """
+    Функция serve запускает заглушку в отдельном потоке.
+
+    :param host: Адрес
+    :param port: Порт, 0 - выбрать свободный
+    :param stub: Экземпляр Stub с параметрами поведения
+    :return: Сервер; адрес для конфига - f'http://{host}:{server.server_port}/', остановка - server.shutdown()
+    """
+    handler = type('StubHandler', (Handler,), {'stub': stub or Stub()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Локальная замена API Neosintez')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--seed', help='json файл с начальными объектами')
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка ответа, секунды')
+    parser.add_argument('--jitter', type=float, default=0.0, help='случайная добавка к задержке, секунды')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов с ошибкой 500')
+    parser.add_argument('--rate-limit', type=float, default=0, help='допустимое число запросов в секунду')
+    parser.add_argument('--no-gzip', action='store_true', help='не сжимать ответы')
+    parser.add_argument('--no-projection', action='store_true', help='игнорировать отбор атрибутов в поиске')
+    parser.add_argument('--no-create-attributes', action='store_true', help='игнорировать атрибуты при создании объекта')
+    args = parser.parse_args()
+
+    stub = Stub(args.latency, args.jitter, args.error_rate, args.rate_limit, not args.no_gzip,
+                not args.no_projection, not args.no_create_attributes)
+    if args.seed:
+        with open(args.seed, encoding='utf-8') as f:
+            stub.load_seed(json.loads(f.read()))
+    server = serve(args.host, args.port, stub)
+    print(f'{datetime.now():%Y-%m-%d %H:%M:%S} Neosintez stub is listening on http://{args.host}:{server.server_port}/')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()